@@ -0,0 +1,135 @@
+# Drives sfu_api.timetable.parser against the local SFU api stand-in (see sfu_api_stub.py)
+# with N concurrent users and reports throughput + p50/p99 latency.
+# Usage (from the project root): python benchmarks/bench_parser.py --users 100 --requests 2000 --latency-ms 150
+import argparse
+import asyncio
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from aiohttp import web
+
+import sfu_api_stub
+
+
+# Parser reads config at import time, so everything has to be set up before importing it
+os.environ.setdefault("TELEGRAM_TOKEN", "benchmark")
+os.environ.setdefault("TELEGRAM_SUPPORT_TOKEN", "benchmark")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+
+def init_args_parser() -> argparse.ArgumentParser:
+	parser = argparse.ArgumentParser(description="SFU timetable parser benchmark")
+	parser.add_argument("--users", type=int, default=50, help="Concurrent users")
+	parser.add_argument("--requests", type=int, default=1000, help="Total requests")
+	parser.add_argument("--groups", type=int, default=20, help="Distinct groups users belong to")
+	parser.add_argument("--mode", choices=["day", "week", "mixed"], default="mixed")
+	parser.add_argument(
+		"--cold", action="store_true", help="Reset timetable cache before every round of requests"
+	)
+	parser.add_argument("--render-executor", choices=["process", "thread"], default="process")
+	parser.add_argument("--render-workers", type=int, default=0, help="0 - one per core")
+	parser.add_argument("--url", default=None, help="Use already running stand-in instead of in-process one")
+	# In-process stand-in settings
+	parser.add_argument("--latency-ms", type=float, default=100)
+	parser.add_argument("--jitter-ms", type=float, default=30)
+	parser.add_argument("--error-rate", type=float, default=0)
+	parser.add_argument("--empty-rate", type=float, default=0)
+	parser.add_argument("--seed", type=int, default=0)
+	return parser
+
+
+def percentile(sorted_values: list[float], p: float) -> float:
+	if len(sorted_values) == 0:
+		return 0.0
+	index: int = min(len(sorted_values) - 1, round(p / 100 * (len(sorted_values) - 1)))
+	return sorted_values[index]
+
+
+async def run(args: argparse.Namespace) -> None:
+	runner: web.AppRunner | None = None
+	if args.url is None:
+		settings = sfu_api_stub.StubSettings(
+			args.latency_ms, args.jitter_ms, args.error_rate, args.empty_rate, seed=args.seed
+		)
+		runner = web.AppRunner(sfu_api_stub.create_app(settings))
+		await runner.setup()
+		site = web.TCPSite(runner, "127.0.0.1", 0)
+		await site.start()
+		port: int = runner.addresses[0][1]
+		os.environ["SFU_API_BASE_URL"] = f"http://127.0.0.1:{port}{sfu_api_stub.ENDPOINT}"
+	else:
+		os.environ["SFU_API_BASE_URL"] = args.url
+
+	from sfu_api import client
+	from sfu_api.timetable import cacher, image_cache, img_generator, parser, render_pool, store
+	from sfu_api.timetable.common import WeekNum
+	from config import SFU_UNI_TIMEZONE
+	from datetime import datetime
+
+	# Never touch the bot's own cache (reset_global_cache below wipes the store) or its rendered images
+	temp_dir = tempfile.TemporaryDirectory(prefix="bench_parser_")
+	store.STORE_PATH = os.path.join(temp_dir.name, "timetable_cache.db")
+	img_generator.IMG_OUTPUT_DIR = os.path.join(temp_dir.name, "_output")
+
+	img_generator.init()
+	render_pool.init(args.render_executor, args.render_workers)
+	store.init_store()
+	cacher.reset_global_cache()
+
+	rng = random.Random(args.seed)
+	groups: list[tuple[str, str]] = [
+		(f"КИ{20 + i % 5}-{i:02d}Б", str(1 + i % 2)) for i in range(args.groups)
+	]
+	latencies: list[float] = []
+	failed: int = 0
+
+	async def one_request() -> None:
+		nonlocal failed
+
+		group, subgroup = rng.choice(groups)
+		mode: str = args.mode if args.mode != "mixed" else rng.choice(["day", "day", "day", "week"])
+		started_at: float = time.perf_counter()
+		if mode == "day":
+			result = await parser.parse_at(group, subgroup, datetime.now(SFU_UNI_TIMEZONE))
+		else:
+			result = await parser.parse_week(group, subgroup, rng.choice([WeekNum.ODD, WeekNum.EVEN]))
+		latencies.append(time.perf_counter() - started_at)
+		if result is None:
+			failed += 1
+
+	started_at: float = time.perf_counter()
+	remaining: int = args.requests
+	while remaining > 0:
+		round_size: int = min(args.users, remaining)
+		if args.cold:
+			cacher.reset_global_cache()
+		await asyncio.gather(*(one_request() for _ in range(round_size)))
+		remaining -= round_size
+	elapsed: float = time.perf_counter() - started_at
+
+	latencies.sort()
+	print(f"requests:   {len(latencies)} ({failed} failed), {args.users} concurrent users, {args.groups} groups")
+	print(f"throughput: {len(latencies) / elapsed:.1f} req/s ({elapsed:.2f}s total)")
+	print(
+		f"latency:    p50 {percentile(latencies, 50) * 1000:.1f}ms, "
+		f"p99 {percentile(latencies, 99) * 1000:.1f}ms, "
+		f"mean {statistics.fmean(latencies) * 1000:.1f}ms, max {latencies[-1] * 1000:.1f}ms"
+	)
+	if runner is not None:
+		print(f"upstream:   {settings.requests_served} requests served by the stand-in")
+		await runner.cleanup()
+	await client.close()
+	render_pool.shutdown()
+	image_cache.flush()
+	store.flush()
+	temp_dir.cleanup()
+
+
+if __name__ == "__main__":
+	logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+	asyncio.run(run(init_args_parser().parse_args()))
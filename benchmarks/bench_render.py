@@ -0,0 +1,189 @@
+# Renders synthetic timetables (1-8 lessons, long wrapped names, week composites, both themes)
+# with sfu_api.timetable.img_generator and reports per-render time, peak memory and output size.
+# Golden images (benchmarks/golden) catch visual regressions, so render optimizations can land safely.
+# The same golden check runs with the tests (tests/test_golden_images.py).
+# Usage (from the project root):
+#   python benchmarks/bench_render.py --repeat 20
+#   python benchmarks/bench_render.py --check-golden   (exit code 1 if something looks different)
+#   python benchmarks/bench_render.py --update-golden  (after an intentional visual change)
+import argparse
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+
+# img_generator reads config at import time
+os.environ.setdefault("TELEGRAM_TOKEN", "benchmark")
+os.environ.setdefault("TELEGRAM_SUPPORT_TOKEN", "benchmark")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+from PIL import Image, ImageChops
+from PIL.Image import Image as ImageType
+
+from sfu_api.timetable import img_generator
+from sfu_api.timetable.common import Day, Lesson, LessonType, WeekNum
+
+
+GOLDEN_DIR: str = os.path.join(os.path.dirname(os.path.abspath(__file__)), "golden")
+# Fraction of pixels allowed to differ (font rasterization differs a bit between FreeType versions)
+GOLDEN_TOLERANCE: float = 0.001
+LESSON_TIMES: list[str] = [
+	"08:30-10:05", "10:15-11:50", "12:00-13:35", "14:10-15:45",
+	"15:55-17:30", "17:40-19:15", "19:25-21:00", "21:10-22:45",
+]
+LONG_NAME: str = (
+	"Проектирование и разработка высоконагруженных распределённых информационных систем "
+	"с элементами машинного обучения и анализа больших данных (курсовой проект)"
+)
+
+
+def make_lesson(i: int, long: bool = False) -> Lesson:
+	lesson_type: LessonType = list(LessonType)[i % len(LessonType)]
+	building: str = "Главный учебный корпус" if i % 2 else "Корпус №17"
+	return Lesson(
+		name=LONG_NAME if long else f"Дисциплина №{i + 1}",
+		class_type=lesson_type,
+		duration_time=LESSON_TIMES[i % len(LESSON_TIMES)],
+		full_location=f"{building}, ауд. {100 + i}" + (", вход со двора, третий этаж, направо" if long else ""),
+		building=building,
+		room=str(100 + i),
+		teacher="Константинопольский-Задунайский Александр Владимирович" if long else "Иванов И.И.",
+		sync_status="асинхронно" if i % 3 == 0 else "синхронно",
+	)
+
+
+def make_day(day_num: int, lessons_count: int, long: bool = False) -> Day:
+	lessons: list[Lesson] = [make_lesson(i, long) for i in range(lessons_count)]
+	return Day(day_num, WeekNum.ODD, "КИ00-00Б", 1, lessons)
+
+
+def make_fixtures() -> dict[str, list[Day]]:
+	"""@return: name -> days (one day - day image, several - week image)"""
+	fixtures: dict[str, list[Day]] = {
+		f"day_{count}_lessons": [make_day(count % 6, count)] for count in (1, 3, 5, 8)
+	}
+	fixtures["day_long_names"] = [make_day(2, 4, long=True)]
+	fixtures["day_off"] = [make_day(6, 0)]
+	fixtures["week"] = [make_day(day_num, count) for day_num, count in enumerate([4, 2, 0, 6, 3, 1])]
+	return fixtures
+
+
+def render(days: list[Day], dark_theme: bool) -> ImageType:
+	if len(days) == 1:
+		return img_generator.day_image(days[0], dark_theme)
+	return img_generator.week_image(days, dark_theme)
+
+
+def golden_path(name: str, dark_theme: bool) -> str:
+	# Lossless WebP keeps goldens small
+	return os.path.join(GOLDEN_DIR, f"{name}_{'dark' if dark_theme else 'light'}.webp")
+
+
+def compare(actual: ImageType, expected: ImageType) -> tuple[float, int]:
+	"""@return: (fraction of pixels that differ, max difference of a single channel)"""
+	if actual.size != expected.size:
+		return 1.0, 255
+	diff: ImageType = ImageChops.difference(actual.convert("RGB"), expected.convert("RGB"))
+	if diff.getbbox() is None:
+		return 0.0, 0
+	different_pixels: int = sum(1 for pixel in diff.getdata() if pixel != (0, 0, 0))
+	max_channel_diff: int = max(channel_max for _, channel_max in diff.getextrema())
+	return different_pixels / (actual.width * actual.height), max_channel_diff
+
+
+def check_golden(fixtures: dict[str, list[Day]], tolerance: float, diff_dir: str | None) -> bool:
+	ok: bool = True
+	for name, days in fixtures.items():
+		for dark_theme in (True, False):
+			path: str = golden_path(name, dark_theme)
+			if not os.path.isfile(path):
+				print(f"MISSING  {os.path.basename(path)} (run with --update-golden)")
+				ok = False
+				continue
+
+			actual: ImageType = render(days, dark_theme)
+			with Image.open(path) as expected:
+				size_matches: bool = actual.size == expected.size
+				different, max_diff = compare(actual, expected)
+			passed: bool = size_matches and different <= tolerance
+			ok = ok and passed
+			print(
+				f"{'OK' if passed else 'FAIL':<8} {os.path.basename(path)}: {different * 100:.3f}% pixels differ "
+				f"(max channel diff {max_diff})" + ("" if size_matches else f", size {actual.size} != {expected.size}")
+			)
+			if not passed and diff_dir is not None:
+				os.makedirs(diff_dir, exist_ok=True)
+				actual.save(os.path.join(diff_dir, os.path.basename(path).replace(".webp", ".actual.png")))
+	return ok
+
+
+def update_golden(fixtures: dict[str, list[Day]]) -> None:
+	os.makedirs(GOLDEN_DIR, exist_ok=True)
+	for name, days in fixtures.items():
+		for dark_theme in (True, False):
+			path: str = golden_path(name, dark_theme)
+			render(days, dark_theme).save(path, format="WEBP", lossless=True)
+			print(f"Updated {os.path.basename(path)}")
+
+
+def benchmark(fixtures: dict[str, list[Day]], repeat: int, image_format: str) -> None:
+	# Fonts/layouts/sprites are warm in render workers, so they're warmed up here too (see render_pool)
+	img_generator.preload_fonts()
+	img_generator.preload_sprites()
+	for days in fixtures.values():
+		render(days, True)
+		render(days, False)
+
+	print(f"{'fixture':<24} {'theme':<6} {'size':>10} {'draw ms':>8} {'encode ms':>10} {'bytes':>9} {'peak KiB':>9}  encoding")
+	for name, days in fixtures.items():
+		for dark_theme in (True, False):
+			draw_times: list[float] = []
+			encode_times: list[float] = []
+			peaks: list[int] = []
+			for _ in range(repeat):
+				tracemalloc.start()
+				started_at: float = time.perf_counter()
+				image: ImageType = render(days, dark_theme)
+				drawn_at: float = time.perf_counter()
+				encoded: img_generator.EncodedImage = img_generator.encode(image, image_format)
+				draw_times.append(drawn_at - started_at)
+				encode_times.append(time.perf_counter() - drawn_at)
+				# Pillow's pixel buffers aren't tracked by tracemalloc, so they're added separately
+				peaks.append(tracemalloc.get_traced_memory()[1] + image.width * image.height * len(image.getbands()))
+				tracemalloc.stop()
+
+			print(
+				f"{name:<24} {'dark' if dark_theme else 'light':<6} {f'{image.width}x{image.height}':>10} "
+				f"{statistics.median(draw_times) * 1000:>8.1f} {statistics.median(encode_times) * 1000:>10.1f} "
+				f"{len(encoded.data):>9} {max(peaks) / 1024:>9.0f}  {encoded.encoding}"
+			)
+
+
+def init_args_parser() -> argparse.ArgumentParser:
+	parser = argparse.ArgumentParser(description="Timetable rendering benchmark + golden image checks")
+	parser.add_argument("--repeat", type=int, default=10, help="Renders per fixture and theme (medians are reported)")
+	parser.add_argument(
+		"--format", default=img_generator.IMAGE_FORMAT, choices=["png", "png-rgb", "webp"], help="See img_generator.encode"
+	)
+	parser.add_argument("--check-golden", action="store_true", help="Compare renders with golden images")
+	parser.add_argument("--update-golden", action="store_true", help="Overwrite golden images with current renders")
+	parser.add_argument(
+		"--tolerance", type=float, default=GOLDEN_TOLERANCE, help="Fraction of pixels allowed to differ"
+	)
+	parser.add_argument("--diff-dir", default=None, help="Where to save renders that didn't match their golden image")
+	return parser
+
+
+if __name__ == "__main__":
+	args = init_args_parser().parse_args()
+	if not os.path.isfile(img_generator.FONT_PATH):
+		sys.exit(f"No font at `{img_generator.FONT_PATH}`, run from the project root")
+
+	fixtures: dict[str, list[Day]] = make_fixtures()
+	if args.update_golden:
+		update_golden(fixtures)
+	elif args.check_golden:
+		sys.exit(0 if check_golden(fixtures, args.tolerance, args.diff_dir) else 1)
+	else:
+		benchmark(fixtures, args.repeat, args.format)
@@ -0,0 +1,173 @@
+# Local stand-in for "edu.sfu-kras.ru/api/timetable/get", so the parser can be load-tested
+# without hammering the real university API.
+# Usage: python benchmarks/sfu_api_stub.py --port 8080 --latency-ms 150 --error-rate 0.05
+# (and then run the bot with SFU_API_BASE_URL=http://127.0.0.1:8080/api/timetable/get)
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import sys
+import zlib
+from urllib import parse
+
+from aiohttp import web
+
+
+ENDPOINT: str = "/api/timetable/get"
+# Same two formats as parser.URL_VARIANTS
+TARGET_FORMATS: list[re.Pattern] = [
+	re.compile(r"^(?P<group>.+) \((?P<subgroup>\d+) подгруппа\)$"),
+	re.compile(r"^(?P<group>.+) \(подгруппа (?P<subgroup>\d+)\)$"),
+]
+LESSON_TIMES: list[str] = [
+	"08:30-10:05", "10:15-11:50", "12:00-13:35", "14:10-15:45", "15:55-17:30", "17:40-19:15",
+]
+LESSON_TYPES: list[str] = ["лекция", "пр. занятие", "лаб. работа"]
+SUBJECTS: list[str] = [
+	"Математический анализ",
+	"Алгебра и геометрия",
+	"Программирование",
+	"Физическая культура и спорт",
+	"Иностранный язык",
+	"Основы российской государственности",
+	"Теория вероятностей, математическая статистика и случайные процессы",
+	"Проектирование и разработка высоконагруженных распределённых информационных систем",
+]
+TEACHERS: list[str] = ["Иванов И.И.", "Петрова А.С.", "Сидоров П.П.", "Кузнецова Е.В."]
+BUILDINGS: list[str] = ["Корпус №17", "Корпус №22", "Главный учебный корпус"]
+
+
+class StubSettings:
+	def __init__(
+		self, latency_ms: float = 0, jitter_ms: float = 0, error_rate: float = 0,
+		empty_rate: float = 0, fixtures_dir: str | None = None, seed: int = 0
+	):
+		self.latency_ms: float = latency_ms
+		self.jitter_ms: float = jitter_ms
+		# Chance of "500 Internal Server Error"
+		self.error_rate: float = error_rate
+		# Chance of an empty timetable (happens with the real api every now and then)
+		self.empty_rate: float = empty_rate
+		self.fixtures_dir: str | None = fixtures_dir
+		self.random: random.Random = random.Random(seed)
+		self.requests_served: int = 0
+
+
+def generate_timetable(group: str, subgroup: str) -> list[dict]:
+	"""Deterministic (per group/subgroup) fake timetable in the same format as SFU api"""
+	rng = random.Random(zlib.crc32(f"{group}|{subgroup}".encode()))
+	items: list[dict] = []
+	# Sfu api counts days from 1 (Monday) and returns them sorted by day
+	for day in range(1, 7):
+		for week in ("1", "2"):
+			lessons_count: int = rng.choice([0, 1, 2, 3, 3, 4, 4, 5, 6])
+			for time in sorted(rng.sample(LESSON_TIMES, lessons_count)):
+				building: str = rng.choice(BUILDINGS)
+				room: str = str(rng.randint(100, 520))
+				items.append({
+					"day": str(day),
+					"week": week,
+					"time": time,
+					"subject": rng.choice(SUBJECTS),
+					"type": rng.choice(LESSON_TYPES),
+					"teacher": rng.choice(TEACHERS),
+					"building": building,
+					"room": room,
+					"place": f"{building}, ауд. {room}",
+					"sync": rng.choice(["синхронно", "синхронно", "асинхронно"]),
+				})
+	return sorted(items, key=lambda item: item["day"])
+
+
+def url_format_for(group: str) -> int:
+	"""Just like the real thing, each group only answers to one of the url variants"""
+	return zlib.crc32(group.encode()) % len(TARGET_FORMATS)
+
+
+def _extract_target(request: web.Request) -> str | None:
+	if "target" in request.query:
+		return request.query["target"]
+	# parser builds urls like ".../get&target=..." (no "?"), so target ends up in the path
+	_, _, tail = request.path.partition("&")
+	return parse.parse_qs(tail).get("target", [None])[0]
+
+
+def _load_fixture(fixtures_dir: str, target: str) -> dict | None:
+	path: str = os.path.join(fixtures_dir, f"{target}.json")
+	if not os.path.isfile(path):
+		return None
+	with open(path, encoding="utf-8") as file:
+		return json.load(file)
+
+
+async def handle_timetable(request: web.Request) -> web.Response:
+	settings: StubSettings = request.app["settings"]
+	settings.requests_served += 1
+
+	latency: float = max(0.0, settings.latency_ms + settings.random.uniform(-1, 1) * settings.jitter_ms)
+	if latency:
+		await asyncio.sleep(latency / 1000)
+	if settings.random.random() < settings.error_rate:
+		return web.Response(status=500, text="Internal Server Error")
+
+	target: str | None = _extract_target(request)
+	if target is None:
+		return web.Response(status=400, text="No target")
+	if settings.random.random() < settings.empty_rate:
+		return web.json_response({"timetable": [], "target": target})
+
+	# Recorded fixtures win over generated data
+	if settings.fixtures_dir is not None:
+		recorded: dict | None = _load_fixture(settings.fixtures_dir, target)
+		if recorded is not None:
+			return web.json_response(recorded)
+
+	for i, target_format in enumerate(TARGET_FORMATS):
+		match = target_format.match(target)
+		if match is None:
+			continue
+		# "Wrong" url variant for that group -> empty response (see parser.URL_VARIANTS)
+		if url_format_for(match["group"]) != i:
+			break
+		return web.json_response({
+			"timetable": generate_timetable(match["group"], match["subgroup"]),
+			"target": target,
+		})
+
+	return web.json_response({"timetable": [], "target": target})
+
+
+def create_app(settings: StubSettings) -> web.Application:
+	app = web.Application()
+	app["settings"] = settings
+	# "{tail:.*}" because of the ".../get&target=..." urls (see _extract_target)
+	app.router.add_get(ENDPOINT + "{tail:.*}", handle_timetable)
+	return app
+
+
+def main() -> None:
+	args_parser = argparse.ArgumentParser(description="Local stand-in for SFU timetable api")
+	args_parser.add_argument("--host", default="127.0.0.1")
+	args_parser.add_argument("--port", type=int, default=8080)
+	args_parser.add_argument("--latency-ms", type=float, default=0)
+	args_parser.add_argument("--jitter-ms", type=float, default=0)
+	args_parser.add_argument("--error-rate", type=float, default=0)
+	args_parser.add_argument("--empty-rate", type=float, default=0)
+	args_parser.add_argument(
+		"--fixtures", default=None, help="Directory with recorded responses named `{target}.json`"
+	)
+	args_parser.add_argument("--seed", type=int, default=0)
+	args = args_parser.parse_args()
+
+	settings = StubSettings(
+		args.latency_ms, args.jitter_ms, args.error_rate, args.empty_rate, args.fixtures, args.seed
+	)
+	web.run_app(create_app(settings), host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+	logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+	main()
@@ -4,7 +4,7 @@ import logging
 import os
 import sys
 
-from bot import support, telegram
+from bot import photo_cache, support, telegram
 from database import init_db
 from sfu_api import timetable
 
@@ -31,14 +31,14 @@ def main() -> None:
             logging.info("Starting the default bot")
             init_db()
             timetable.img_generator.init()
-            timetable.cacher.init_cache_scheduler()
+            timetable.cacher.load_persisted_cache()
+            photo_cache.load()
             telegram.start()
     except KeyboardInterrupt:
         logging.info("Process interrupted")
     except Exception as e:
         logging.error("Unknown and unhandled exception occurred", exc_info=e)
     finally:
-        asyncio.run(timetable.parser.close_http_session())
         if args.support_enabled:
             asyncio.run(support.close())
         else:
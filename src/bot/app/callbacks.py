@@ -10,6 +10,7 @@ CALLBACK_AUTH: str = "btn_auth"
 CALLBACK_RE_LOGIN: str = "btn_re_login"
 CALLBACK_SUPPORT: str = "btn_support"
 CALLBACK_SELECT_LANG: str = "btn_select_lang"
+CALLBACK_TOGGLE_DISPLAY_MODE: str = "btn_toggle_display_mode"
 CALLBACK_TO_MENU: str = "btn_go_to_menu"
 
 CALLBACK_SELECT_EN: str = "btn_select_en"
@@ -17,6 +18,8 @@ CALLBACK_SELECT_RU: str = "btn_select_ru"
 
 CALLBACK_DB_GC: str = "btn_clear_db"
 CALLBACK_CLEAR_TIMETABLE_CACHE: str = "btn_clear_timetable_cache"
+CALLBACK_INVALIDATE_GROUP_CACHE: str = "btn_invalidate_group_cache"
+CALLBACK_METRICS: str = "btn_metrics"
 
 CALLBACK_THIS_WEEK: str = "btn_this_week"
 CALLBACK_EVEN_WEEK: str = "btn_even_week"
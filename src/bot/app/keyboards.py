@@ -115,6 +115,9 @@ def init(_: Callable) -> None:
                 text=_("Выбрать язык / Choose language", locale=lang), callback_data=CALLBACK_SELECT_LANG
             )
         )
+        settings_keyboard.row(__map_callback_to_text(
+            text=_("Расписание картинкой/текстом", locale=lang), callback_data=CALLBACK_TOGGLE_DISPLAY_MODE
+        ))
         settings_keyboard.row(__map_callback_to_text(
             text=_("В меню", locale=lang), callback_data=CALLBACK_TO_MENU
         ))
@@ -141,6 +144,12 @@ def init(_: Callable) -> None:
         admin_panel_keyboard.add(__map_callback_to_text(
             text=_("Очистить кэш расписаний", locale=lang), callback_data=CALLBACK_CLEAR_TIMETABLE_CACHE
         ))
+        admin_panel_keyboard.add(__map_callback_to_text(
+            text=_("Сбросить кэш группы", locale=lang), callback_data=CALLBACK_INVALIDATE_GROUP_CACHE
+        ))
+        admin_panel_keyboard.add(__map_callback_to_text(
+            text=_("Метрики", locale=lang), callback_data=CALLBACK_METRICS
+        ))
         admin_panel_keyboard.row(__map_callback_to_text(
             text=_("В меню", locale=lang), callback_data=CALLBACK_TO_MENU
         ))
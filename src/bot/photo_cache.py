@@ -0,0 +1,87 @@
+# Telegram keeps every uploaded file, so each image only has to be uploaded once,
+# after that it can be re-sent by its file_id (no upload bandwidth, much faster)
+import io
+import logging
+import os
+
+from aiogram import Bot, types
+from aiogram.utils import exceptions
+
+import metrics
+from sfu_api.timetable import image_cache, store
+
+
+# path -> (fingerprint, file_id); see load()
+_file_ids: dict[str, tuple[str, str]] = {}
+
+
+def load() -> None:
+	"""
+	Loads file ids from the store, MUST be called before polling starts (after cacher.load_persisted_cache):
+	reads wait for the store thread, so they shouldn't happen on the bot's event loop.
+	Writes (remember/forget) are just queued on the store thread, so they don't block it.
+	File ids of images that are gone (retired/evicted while the bot was running) are deleted here,
+	image paths are content-addressed, so they would never be used again.
+	"""
+	_file_ids.clear()
+	gone: list[str] = []
+	for path, fingerprint, file_id in store.load_file_ids():
+		if image_cache.contains(path):
+			_file_ids[path] = (fingerprint, file_id)
+		else:
+			gone.append(path)
+
+	if len(gone) != 0:
+		store.delete_file_ids(gone)
+		logging.info(f"Forgot {len(gone)} Telegram file ids of deleted images")
+
+
+def get_file_id(path: str) -> str | None:
+	"""@return: Telegram file_id for image at path; None - if it wasn't uploaded yet or changed since then"""
+	cached: tuple[str, str] | None = _file_ids.get(path, None)
+	if cached is None:
+		return None
+
+	if cached[0] != image_cache.fingerprint(path):
+		forget(path)
+		return None
+	return cached[1]
+
+
+def remember(path: str, file_id: str) -> None:
+	fingerprint: str | None = image_cache.fingerprint(path)
+	if fingerprint is None:
+		return
+
+	_file_ids[path] = (fingerprint, file_id)
+	store.save_file_id(path, fingerprint, file_id)
+
+
+def forget(path: str) -> None:
+	_file_ids.pop(path, None)
+	store.delete_file_id(path)
+
+
+async def send_photo(bot: Bot, chat_id: int, path: str) -> None:
+	"""Sends image at path by its file_id if possible, otherwise uploads it (and remembers its file_id)"""
+	file_id: str | None = get_file_id(path)
+	if file_id is not None:
+		try:
+			with metrics.photo_sends.time(method="file_id"):
+				await bot.send_photo(chat_id=chat_id, photo=file_id)
+			return
+		except exceptions.BadRequest as err:
+			# File_id got invalidated on Telegram's side (rare, but possible), so just upload again
+			logging.warning(f"Cached file_id for `{path}` didn't work: {err}")
+			forget(path)
+
+	data: bytes | None = await image_cache.get(path)
+	if data is None:
+		raise FileNotFoundError(f"No timetable image at `{path}`")
+	# Straight from memory, no filesystem round-trip
+	photo = types.InputFile(io.BytesIO(data), filename=os.path.basename(path))
+	with metrics.photo_sends.time(method="upload"):
+		message = await bot.send_photo(chat_id=chat_id, photo=photo)
+	if message.photo:
+		# Last one is the biggest one (i.e. original)
+		remember(path, message.photo[-1].file_id)
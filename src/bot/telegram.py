@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import functools
 from datetime import datetime, timedelta
@@ -13,13 +14,17 @@ from aiogram.dispatcher.filters.state import State, StatesGroup
 from emoji import emojize
 
 import database as db
+import metrics
+from sfu_api import client as sfu_client
 from sfu_api import timetable, usport
 from sfu_api.timetable import parser as timetable_parser
-from bot import support
+from sfu_api.timetable import image_cache, prefetcher, render_pool, store, text_generator
+from bot import photo_cache, support
 from bot.app import keyboards
 from bot.app.keyboards import Keyboard
 from bot.app.callbacks import *
 from config import TELEGRAM_TOKEN, I18N_DOMAIN, I18N_LOCALES_DIR, SUPPORTED_LANGUAGES, SFU_UNI_TIMEZONE
+from config import METRICS_HOST, METRICS_PORT
 from validation import *
 
 
@@ -30,6 +35,8 @@ dp.message_handlers.once = False
 i18n = I18nMiddleware(I18N_DOMAIN, I18N_LOCALES_DIR)
 dp.setup_middleware(i18n)
 _ = i18n.gettext  # alias for translating text
+# Event loop only keeps weak references to tasks, so without this one warm-up could be garbage collected mid-run
+_warm_up_task: asyncio.Task | None = None
 
 
 class UserDataInputState(StatesGroup):
@@ -42,12 +49,16 @@ class SupportMessageInput(StatesGroup):
 	user_message = State()
 
 
+class InvalidateGroupCacheInput(StatesGroup):
+	group = State()
+
+
 @dp.message_handler(commands=["start"])
 async def welcome_menu(message: types.Message) -> None:
-	_lang: str = get_lang_for(message.from_user.id)
+	_lang: str = await get_lang_for(message.from_user.id)
 
 	# Code duplication is bad, but maaaaaaaaaaaaan ctrl+c ctrl+v is just magic...
-	if db.get_user_if_authenticated(message.from_user.id) is None:
+	if await db.get_user_if_authenticated_async(message.from_user.id) is None:
 		await UserDataInputState.login.set()
 		await message.reply(_("Добро пожаловать, авторизуйтесь для начала работы", locale=_lang))
 		await message.answer(_("Введите ваш логин СФУ.\nПример: NSurname-UG24", locale=_lang))
@@ -94,7 +105,7 @@ def dp_callbacks_to_texts(callback_data: Any):
 	return decorator
 
 
-def get_lang_for(user_id: int, fetch_db_if_not_found: bool = True) -> str:
+async def get_lang_for(user_id: int, fetch_db_if_not_found: bool = True) -> str:
 	"""
 	Returns language based on telegram state or db or default values
 	@param user_id: Telegram id
@@ -102,7 +113,7 @@ def get_lang_for(user_id: int, fetch_db_if_not_found: bool = True) -> str:
 	@return: Language code
 	"""
 	# TODO: add telegram state/cache to avoid hitting db every time...
-	lang: str | None = db.get_lang_for(user_id)
+	lang: str | None = await db.get_lang_for_async(user_id)
 	if lang is None:
 		return "ru"
 	return lang
@@ -116,7 +127,7 @@ def update_interaction_time(func: Callable) -> Callable:
 	"""
 
 	@functools.wraps(func)
-	def inner(*args, **kwargs):
+	async def inner(*args, **kwargs):
 		user_id: int | None = None
 		for arg in args:
 			if isinstance(arg, types.Message):
@@ -125,8 +136,8 @@ def update_interaction_time(func: Callable) -> Callable:
 				user_id = arg.from_user.id
 		
 		if user_id is not None:
-			db.update_interaction_time_for(user_id)
-		return func(*args, **kwargs)
+			await db.update_interaction_time_for_async(user_id)
+		return await func(*args, **kwargs)
 	
 	return inner
 # endregion -- Utils/Other
@@ -136,7 +147,7 @@ def update_interaction_time(func: Callable) -> Callable:
 @dp_callbacks_to_texts(CALLBACK_ADMIN_PANEL)
 async def admin_panel(message: types.Message) -> None:
 	if is_admin(message.from_user.id):
-		_lang: str = get_lang_for(message.from_user.id)
+		_lang: str = await get_lang_for(message.from_user.id)
 		await message.answer(
 			_("Админ-панель", locale=_lang), reply_markup=keyboards.get(Keyboard.ADMIN_PANEL, _lang)
 		)
@@ -145,22 +156,53 @@ async def admin_panel(message: types.Message) -> None:
 @dp_callbacks_to_texts(CALLBACK_DB_GC)
 async def clear_db(message: types.Message) -> None:
 	if is_admin(message.from_user.id):
-		db.remove_old_profiles()
-		await message.answer(_("База данных почищена", locale=get_lang_for(message.from_user.id) + '!'))
+		await db.remove_old_profiles_async()
+		await message.answer(_("База данных почищена", locale=await get_lang_for(message.from_user.id) + '!'))
 
 
 @dp_callbacks_to_texts(CALLBACK_CLEAR_TIMETABLE_CACHE)
 async def clear_timetable_cache(message: types.Message) -> None:
 	if is_admin(message.from_user.id):
 		timetable.cacher.reset_global_cache()
-		await message.answer(_("Кэш изображений удалён", locale=get_lang_for(message.from_user.id)) + '!')
+		await message.answer(_("Кэш изображений удалён", locale=await get_lang_for(message.from_user.id)) + '!')
+
+
+@dp_callbacks_to_texts(CALLBACK_INVALIDATE_GROUP_CACHE)
+async def invalidate_group_cache(message: types.Message) -> None:
+	if is_admin(message.from_user.id):
+		await InvalidateGroupCacheInput.group.set()
+		await message.answer(
+			_("Введите группу (и подгруппу через пробел, если нужно).\nПример: КИ21-17/1Б 2", locale=await get_lang_for(message.from_user.id))
+		)
+
+
+@dp.message_handler(state=InvalidateGroupCacheInput.group)
+async def invalidate_group_cache_input(message: types.Message, state: FSMContext) -> None:
+	await state.finish()
+	if not is_admin(message.from_user.id) or not message.text:
+		return
+
+	group, _separator, subgroup = message.text.strip().rpartition(' ')
+	if not group or not subgroup.isdigit():
+		group, subgroup = message.text.strip(), None
+	removed: int = timetable.cacher.invalidate(group, subgroup)
+	await message.answer(
+		_("Удалено записей из кэша", locale=await get_lang_for(message.from_user.id)) + f": {removed}"
+	)
+
+
+@dp_callbacks_to_texts(CALLBACK_METRICS)
+async def show_metrics(message: types.Message) -> None:
+	if is_admin(message.from_user.id):
+		cache_stats: str = ", ".join(f"{name}: {value}" for name, value in timetable.cacher.stats().items())
+		await message.answer(f"{cache_stats}\n\n{metrics.summary()}")
 # endregion -- ADMIN
 
 
 # region    -- COMMON
 @dp_callbacks_to_texts(CALLBACK_TO_MENU)
 async def back_to_menu(message: types.Message) -> None:
-	_lang: str = get_lang_for(message.from_user.id)
+	_lang: str = await get_lang_for(message.from_user.id)
 
 	if is_admin(message.from_user.id):
 		await message.reply(
@@ -177,11 +219,11 @@ async def back_to_menu(message: types.Message) -> None:
 @dp_callbacks_to_texts(CALLBACK_PE_QR)
 @update_interaction_time
 async def pe_qr(message: types.Message) -> None:
-	student: db.UserModel | None = db.get_user_if_authenticated(message.from_user.id)
+	student: db.UserModel | None = await db.get_user_if_authenticated_async(message.from_user.id)
 
 	if student is None:
 		await message.answer(
-			_("Ошибка! Вы не авторизовались", locale=get_lang_for(message.from_user.id, False))
+			_("Ошибка! Вы не авторизовались", locale=await get_lang_for(message.from_user.id, False))
 		)
 	else:
 		try:
@@ -202,7 +244,7 @@ async def pe_qr(message: types.Message) -> None:
 # region    -- Timetable
 @dp_callbacks_to_texts(CALLBACK_TIMETABLE_GENERAL)
 async def timetable_sequence_start(message: types.Message) -> None:
-	_lang: str = get_lang_for(message.from_user.id)
+	_lang: str = await get_lang_for(message.from_user.id)
 	await message.answer(
 		_("Выберите неделю", locale=_lang), reply_markup=keyboards.get(Keyboard.TIMETABLE, _lang)
 	)
@@ -221,36 +263,59 @@ async def timetable_today(message: types.Message) -> None:
 
 
 async def _timetable_day_at(message: types.Message, at: datetime) -> None:
-	student: db.UserModel | None = db.get_user_if_authenticated(message.from_user.id)
+	student: db.UserModel | None = await db.get_user_if_authenticated_async(message.from_user.id)
 	if student is None:
 		await message.answer(
-			_("Ошибка! Вы не авторизовались", locale=get_lang_for(message.from_user.id, False))
+			_("Ошибка! Вы не авторизовались", locale=await get_lang_for(message.from_user.id, False))
 		)
 		return
 
+	if student.display_mode == db.DISPLAY_MODE_TEXT:
+		day: timetable_parser.Day | None = await timetable_parser.get_day_at(student.group_name, student.subgroup, at)
+		if day is None:
+			await message.answer(
+				_("Что-то пошло не так. Попробуйте позже или напишите в поддержку", locale=student.lang) + ":()"
+			)
+		else:
+			await message.answer(text_generator.day_text(day), parse_mode=types.ParseMode.HTML)
+		return
+
 	img_path: str | None = await timetable_parser.parse_at(student.group_name, student.subgroup, at)
 	if img_path is None:
 		await message.answer(
 			_("Что-то пошло не так. Попробуйте позже или напишите в поддержку", locale=student.lang) + ":()"
 		)
 	else:
-		with open(img_path, mode="rb") as img_file:
-			await bot.send_photo(chat_id=message.chat.id, photo=img_file)
+		# Refresh might retire that image in the meantime
+		with timetable.cacher.lease(img_path):
+			await photo_cache.send_photo(bot, message.chat.id, img_path)
 
 
 @update_interaction_time
 async def _timetable_week(message: types.Message, target_week_num: int = timetable_parser.WeekNum.CURRENT) -> None:
-	student: db.UserModel | None = db.get_user_if_authenticated(message.from_user.id)
+	student: db.UserModel | None = await db.get_user_if_authenticated_async(message.from_user.id)
 	if student is None:
 		await message.answer(_("Ошибка! Вы не авторизовались"))
 		return
 
+	if student.display_mode == db.DISPLAY_MODE_TEXT:
+		days: list[timetable_parser.Day] | None = await timetable_parser.get_week(
+			student.group_name, student.subgroup, target_week_num
+		)
+		if days is None:
+			await message.answer(_("Что-то пошло не так. Попробуйте позже или напишите в поддержку") + ":()")
+			return
+		for text in text_generator.week_texts(days):
+			await message.answer(text, parse_mode=types.ParseMode.HTML)
+		return
+
 	img_path: str | None = await timetable_parser.parse_week(student.group_name, student.subgroup, target_week_num)
 	if img_path is None:
 		await message.answer(_("Что-то пошло не так. Попробуйте позже или напишите в поддержку") + ":()")
 	else:
-		with open(img_path, mode="rb") as img_file:
-			await bot.send_photo(chat_id=message.chat.id, photo=img_file)
+		# Refresh might retire that image in the meantime
+		with timetable.cacher.lease(img_path):
+			await photo_cache.send_photo(bot, message.chat.id, img_path)
 
 
 @dp_callbacks_to_texts(CALLBACK_THIS_WEEK)
@@ -272,7 +337,7 @@ async def timetable_week_odd(message: types.Message) -> None:
 # region    -- Settings
 @dp_callbacks_to_texts(CALLBACK_SETTINGS)
 async def settings(message: types.Message) -> None:
-	_lang: str = get_lang_for(message.from_user.id)
+	_lang: str = await get_lang_for(message.from_user.id)
 	await message.answer(
 		_("Выберите настройки", locale=_lang), reply_markup=keyboards.get(Keyboard.SETTINGS, _lang)
 	)
@@ -280,7 +345,7 @@ async def settings(message: types.Message) -> None:
 
 @dp_callbacks_to_texts(CALLBACK_SELECT_LANG)
 async def choose_language(message: types.Message) -> None:
-	_lang: str = get_lang_for(message.from_user.id)
+	_lang: str = await get_lang_for(message.from_user.id)
 	await message.answer(
 		_("Выберите язык/Choose your language", locale=_lang),
 		reply_markup=keyboards.get(Keyboard.LANGUAGE_SELECT, _lang),
@@ -290,7 +355,7 @@ async def choose_language(message: types.Message) -> None:
 @dp_callbacks_to_texts(CALLBACK_SELECT_RU)
 async def ru_lang(message: types.Message) -> None:
 	i18n.reload()
-	db.set_lang_for(message.from_user.id, "ru")
+	await db.set_lang_for_async(message.from_user.id, "ru")
 
 	if is_admin(message.from_user.id):
 		await message.answer(
@@ -307,7 +372,7 @@ async def ru_lang(message: types.Message) -> None:
 @dp_callbacks_to_texts(CALLBACK_SELECT_EN)
 async def en_lang(message: types.Message) -> None:
 	i18n.reload()
-	db.set_lang_for(message.from_user.id, "en")
+	await db.set_lang_for_async(message.from_user.id, "en")
 
 	if is_admin(message.from_user.id):
 		await message.answer(
@@ -321,10 +386,26 @@ async def en_lang(message: types.Message) -> None:
 		)
 
 
+@dp_callbacks_to_texts(CALLBACK_TOGGLE_DISPLAY_MODE)
+async def toggle_display_mode(message: types.Message) -> None:
+	_lang: str = await get_lang_for(message.from_user.id)
+	if await db.get_user_if_authenticated_async(message.from_user.id) is None:
+		await message.answer(_("Ошибка! Вы не авторизовались", locale=_lang))
+		return
+
+	# Text is much lighter than images (nothing to render or upload), handy on bad connections
+	if await db.get_display_mode_for_async(message.from_user.id) == db.DISPLAY_MODE_TEXT:
+		await db.set_display_mode_for_async(message.from_user.id, db.DISPLAY_MODE_IMAGE)
+		await message.answer(_("Теперь расписание будет приходить картинкой", locale=_lang))
+	else:
+		await db.set_display_mode_for_async(message.from_user.id, db.DISPLAY_MODE_TEXT)
+		await message.answer(_("Теперь расписание будет приходить текстом", locale=_lang))
+
+
 @dp_callbacks_to_texts(CALLBACK_SUPPORT)
 async def support_message(message: types.Message) -> None:
 	await message.answer(
-		_("Введите ваше сообщение (отправка фото недоступна)", locale=get_lang_for(message.from_user.id))
+		_("Введите ваше сообщение (отправка фото недоступна)", locale=await get_lang_for(message.from_user.id))
 	)
 	await SupportMessageInput.user_message.set()
 # endregion    -- Settings
@@ -344,9 +425,9 @@ async def user_support_message(message: types.Message, state: FSMContext) -> Non
 # region    -- Input profile data
 @dp_callbacks_to_texts(CALLBACK_AUTH)
 async def auth(message: types.Message) -> None:
-	_lang: str = get_lang_for(message.from_user.id)
+	_lang: str = await get_lang_for(message.from_user.id)
 
-	if db.get_user_if_authenticated(message.from_user.id) is None:
+	if await db.get_user_if_authenticated_async(message.from_user.id) is None:
 		await UserDataInputState.login.set()
 		await message.answer(
 			_("Введите ваш логин СФУ.\nПример: NSurname-UG24", locale=_lang)
@@ -360,7 +441,7 @@ async def auth(message: types.Message) -> None:
 
 @dp_callbacks_to_texts(CALLBACK_RE_LOGIN)
 async def re_login(message: types.Message) -> None:
-	_lang: str = get_lang_for(message.from_user.id)
+	_lang: str = await get_lang_for(message.from_user.id)
 
 	await UserDataInputState.login.set()
 	await message.answer(
@@ -372,7 +453,7 @@ async def re_login(message: types.Message) -> None:
 @dp.message_handler(state=UserDataInputState.login)
 async def add_login(message: types.Message, state: FSMContext) -> None:
 	async with state.proxy() as data:
-		_lang: str = get_lang_for(message.from_user.id)
+		_lang: str = await get_lang_for(message.from_user.id)
 		data["lang"] = _lang
 		data["login"] = format_sfu_login(message.text)
 
@@ -412,16 +493,53 @@ async def add_subgroup(message: types.Message, state: FSMContext) -> None:
 			)
 			return
 
-		db.create_or_replace_user(message.from_user.id, data["login"], data["group"], data["subgroup"], _lang)
+		await db.create_or_replace_user_async(message.from_user.id, data["login"], data["group"], data["subgroup"], _lang)
 		await state.finish()
 		await back_to_menu(message)
 # endregion -- Input profile data
 
 
+async def _warm_up_timetables() -> None:
+	await prefetcher.warm_up(await db.get_all_groups_async())
+
+
+async def _refresh_timetables() -> None:
+	registered: list[tuple[str, str]] = await db.get_all_groups_async()
+	await prefetcher.refresh(sorted(set(registered) | set(timetable.cacher.cached_groups())))
+	# Newly registered groups have nothing to refresh yet
+	await prefetcher.warm_up(registered)
+
+
+async def on_startup(_: Dispatcher) -> None:
+	global _warm_up_task
+
+	render_pool.init()
+	# Scheduler runs jobs on the bot's event loop, so it can only be started from here
+	timetable.cacher.init_cache_scheduler(_refresh_timetables)
+	_warm_up_task = asyncio.get_running_loop().create_task(_warm_up_timetables())
+	if METRICS_PORT != 0:
+		await metrics.start_server(METRICS_HOST, METRICS_PORT)
+
+
+async def on_shutdown(_: Dispatcher) -> None:
+	if _warm_up_task is not None:
+		_warm_up_task.cancel()
+		# Waits until it's actually cancelled, so nothing uses the session/render pool closed below
+		await asyncio.gather(_warm_up_task, return_exceptions=True)
+	# Session lives on the bot's event loop, so it has to be closed there too
+	await sfu_client.close()
+	await metrics.stop_server()
+	render_pool.shutdown()
+	# Images/queries that are still queued would be lost otherwise
+	image_cache.flush()
+	store.flush()
+	db.close()
+
+
 def start() -> None:
 	# See dp_callbacks_to_texts for explanation
 	# keyboards.init(_)
-	executor.start_polling(dp, skip_updates=True)
+	executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
 
 
 async def close() -> None:
@@ -11,6 +11,25 @@ I18N_DOMAIN = "sfu_telegram_bot"
 SUPPORTED_LANGUAGES: list[str] = ["EN", "RU"]
 
 SFU_UNI_TIMEZONE = pytz.timezone("Asia/Krasnoyarsk")
+# Can be pointed to a local stand-in (see benchmarks/sfu_api_stub.py)
+SFU_API_BASE_URL: str = environ.get("SFU_API_BASE_URL", "https://edu.sfu-kras.ru/api/timetable/get")
+# Stale timetables are served (while being refreshed) for up to this long, e.g. when SFU api is down
+TIMETABLE_CACHE_MAX_AGE_MINUTES: int = int(environ.get("TIMETABLE_CACHE_MAX_AGE_MINUTES", 60 * 24 * 7))
+# Where timetable images are rendered: "process" (scales across cores) or "thread" pool
+RENDER_EXECUTOR: str = environ.get("RENDER_EXECUTOR", "process")
+# 0 - one worker per core
+RENDER_WORKERS: int = int(environ.get("RENDER_WORKERS", 0))
+# Rendered images are always kept in memory, disk is an optional spill tier (survives restarts)
+TIMETABLE_IMAGES_ON_DISK: bool = environ.get("TIMETABLE_IMAGES_ON_DISK", "true").lower() in ("1", "true", "yes")
+# Least recently used images are deleted from disk above that
+TIMETABLE_IMAGES_DISK_QUOTA_BYTES: int = int(environ.get("TIMETABLE_IMAGES_DISK_QUOTA_BYTES", 1024 * 1024 * 1024))
+# "png" - palette-quantized PNG, "png-rgb" - full color PNG, "webp" - lossless WebP (smallest)
+TIMETABLE_IMAGE_FORMAT: str = environ.get("TIMETABLE_IMAGE_FORMAT", "png")
+# Images that don't fit are re-encoded with fewer colors (see img_generator.encode)
+TIMETABLE_IMAGE_BYTES_BUDGET: int = int(environ.get("TIMETABLE_IMAGE_BYTES_BUDGET", 512 * 1024))
+# Prometheus metrics endpoint (http://host:port/metrics), port 0 disables it
+METRICS_HOST: str = environ.get("METRICS_HOST", "127.0.0.1")
+METRICS_PORT: int = int(environ.get("METRICS_PORT", 9464))
 
 TELEGRAM_TOKEN: str = environ["TELEGRAM_TOKEN"]
 TELEGRAM_SUPPORT_TOKEN: str = environ["TELEGRAM_SUPPORT_TOKEN"]
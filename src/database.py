@@ -1,15 +1,26 @@
+import asyncio
 import logging
 import sqlite3 as sql
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from datetime import datetime
 from sys import exit
-from typing import Any, Self
+from typing import Any, Callable, Self, TypeVar
 
 from config import SFU_UNI_TIMEZONE
 
 
-db: sql.Connection = sql.connect("database.db", detect_types=sql.PARSE_DECLTYPES)
+# How timetables are sent (see set_display_mode_for)
+DISPLAY_MODE_IMAGE: str = "image"
+DISPLAY_MODE_TEXT: str = "text"
+
+# Note: Once the bot is running the connection is only used from _db_thread (see *_async functions below)
+db: sql.Connection = sql.connect("database.db", detect_types=sql.PARSE_DECLTYPES, check_same_thread=False)
 cur: sql.Cursor = db.cursor()
+# Every query (commit/fsync included) runs here, so a slow disk never freezes the bot's event loop.
+# Single thread == queries never run concurrently and happen in the order they were made
+_db_thread = ThreadPoolExecutor(1, thread_name_prefix="database")
+_T = TypeVar("_T")
 
 
 @dataclass
@@ -20,12 +31,13 @@ class UserModel:
 	subgroup: str = ""
 	lang: str = ""
 	last_time_interaction: datetime = datetime.now()
+	display_mode: str = DISPLAY_MODE_IMAGE
 
 	@classmethod
 	def from_db_tuple(cls, data: tuple[Any]) -> Self | None:
-		if len(data) != 6:
+		if len(data) != 7:
 			logging.error(
-				f"UserModel.from_db_tuple(...) was expecting 6 params, but got: {data}"
+				f"UserModel.from_db_tuple(...) was expecting 7 params, but got: {data}"
 			)
 			return None
 		return UserModel(*data)
@@ -34,7 +46,7 @@ class UserModel:
 def init_db() -> None:
 	try:
 		cur.execute(
-			"""
+			f"""
 			CREATE TABLE IF NOT EXISTS profiles
 			(
 				telegram_id TEXT PRIMARY KEY,
@@ -42,9 +54,14 @@ def init_db() -> None:
 				group_name TEXT,
 				subgroup TEXT,
 				lang TEXT,
-				last_time_interaction DATEONLY
+				last_time_interaction DATEONLY,
+				display_mode TEXT DEFAULT '{DISPLAY_MODE_IMAGE}'
 			)"""
 		)
+		# Profiles from older versions don't have display mode yet
+		columns: list[str] = [row[1] for row in cur.execute("PRAGMA table_info(profiles)").fetchall()]
+		if "display_mode" not in columns:
+			cur.execute(f"ALTER TABLE profiles ADD COLUMN display_mode TEXT DEFAULT '{DISPLAY_MODE_IMAGE}'")
 		db.commit()
 	except sql.Error as err:
 		logging.critical(f"SQL error: {err.sqlite_errorname}", exc_info=err)
@@ -56,8 +73,12 @@ def create_or_replace_user(telegram_id: int, sfu_login: str, group: str, subgrou
 	"""@return: Returns None - if error occurred"""
 	try:
 		_now = datetime.now(SFU_UNI_TIMEZONE)
+		# Note: Display mode survives re-login
 		cur.execute(
-			"INSERT OR REPLACE INTO profiles VALUES(?, ?, ?, ?, ?, ?)",
+			"INSERT INTO profiles(telegram_id, sfu_login, group_name, subgroup, lang, last_time_interaction) "
+			"VALUES(?, ?, ?, ?, ?, ?) "
+			"ON CONFLICT(telegram_id) DO UPDATE SET sfu_login = excluded.sfu_login, group_name = excluded.group_name, "
+			"subgroup = excluded.subgroup, lang = excluded.lang, last_time_interaction = excluded.last_time_interaction",
 			(
 				telegram_id,
 				sfu_login,
@@ -119,6 +140,30 @@ def set_lang_for(telegram_id: int, lang: str) -> None:
 		return None
 
 
+def get_display_mode_for(telegram_id: int) -> str:
+	"""@return: DISPLAY_MODE_IMAGE or DISPLAY_MODE_TEXT (DISPLAY_MODE_IMAGE - if not set or error occurred)"""
+	try:
+		cur.execute("SELECT display_mode FROM profiles WHERE telegram_id == ?", (telegram_id,))
+		data: tuple | None = cur.fetchone()
+
+		if data is None or data[0] is None:
+			return DISPLAY_MODE_IMAGE
+		return data[0]
+	except sql.Error as err:
+		logging.exception(f"SQL error: {err.sqlite_errorname}", exc_info=err)
+		return DISPLAY_MODE_IMAGE
+
+
+def set_display_mode_for(telegram_id: int, display_mode: str) -> None:
+	"""@param display_mode: DISPLAY_MODE_IMAGE or DISPLAY_MODE_TEXT"""
+	try:
+		cur.execute("UPDATE profiles SET display_mode = ? WHERE telegram_id == ?", (display_mode, telegram_id,))
+		db.commit()
+	except sql.Error as err:
+		logging.exception(f"SQL error: {err.sqlite_errorname}", exc_info=err)
+		return None
+
+
 # region    -- Search/Delete
 def get_user_if_authenticated(telegram_id: int) -> UserModel | None:
 	"""@return: User only if ALL fields are present; None - otherwise"""
@@ -139,6 +184,19 @@ def get_user_if_authenticated(telegram_id: int) -> UserModel | None:
 		return None
 
 
+def get_all_groups() -> list[tuple[str, str]]:
+	"""@return: All distinct (group_name, subgroup) pairs of registered users"""
+	try:
+		cur.execute(
+			"SELECT DISTINCT group_name, subgroup FROM profiles "
+			"WHERE group_name IS NOT NULL AND subgroup IS NOT NULL"
+		)
+		return cur.fetchall()
+	except sql.Error as err:
+		logging.exception(f"SQL error: {err.sqlite_errorname}", exc_info=err)
+		return []
+
+
 def remove_old_profiles() -> None:
 	try:
 		cur.execute(
@@ -149,3 +207,58 @@ def remove_old_profiles() -> None:
 		logging.exception(f"SQL error: {err.sqlite_errorname}", exc_info=err)
 		return None
 # endregion -- Search/Delete
+
+
+# region    -- Async (MUST be used from the bot's event loop instead of the functions above)
+async def _run(func: Callable[..., _T], *args: Any) -> _T:
+	return await asyncio.get_running_loop().run_in_executor(_db_thread, func, *args)
+
+
+async def create_or_replace_user_async(
+	telegram_id: int, sfu_login: str, group: str, subgroup: str, lang: str
+) -> UserModel | None:
+	"""See create_or_replace_user"""
+	return await _run(create_or_replace_user, telegram_id, sfu_login, group, subgroup, lang)
+
+
+async def update_interaction_time_for_async(telegram_id: int) -> None:
+	await _run(update_interaction_time_for, telegram_id)
+
+
+async def get_lang_for_async(telegram_id: int) -> str | None:
+	"""See get_lang_for"""
+	return await _run(get_lang_for, telegram_id)
+
+
+async def set_lang_for_async(telegram_id: int, lang: str) -> None:
+	await _run(set_lang_for, telegram_id, lang)
+
+
+async def get_display_mode_for_async(telegram_id: int) -> str:
+	"""See get_display_mode_for"""
+	return await _run(get_display_mode_for, telegram_id)
+
+
+async def set_display_mode_for_async(telegram_id: int, display_mode: str) -> None:
+	await _run(set_display_mode_for, telegram_id, display_mode)
+
+
+async def get_user_if_authenticated_async(telegram_id: int) -> UserModel | None:
+	"""See get_user_if_authenticated"""
+	return await _run(get_user_if_authenticated, telegram_id)
+
+
+async def get_all_groups_async() -> list[tuple[str, str]]:
+	"""See get_all_groups"""
+	return await _run(get_all_groups)
+
+
+async def remove_old_profiles_async() -> None:
+	await _run(remove_old_profiles)
+
+
+def close() -> None:
+	"""Waits for queries that are still in progress (e.g. on shutdown)"""
+	_db_thread.shutdown(wait=True)
+	db.close()
+# endregion -- Async
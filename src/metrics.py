@@ -0,0 +1,172 @@
+# Bare-bones counters/histograms (no extra dependencies) exported in Prometheus text format
+# and summarized for the admin panel (see bot.telegram.show_metrics)
+import logging
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from aiohttp import web
+
+
+# Seconds; SFU api and Telegram uploads are slow, cache lookups are not, so buckets cover both
+DEFAULT_BUCKETS: tuple[float, ...] = (
+	0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+)
+METRICS_PREFIX: str = "sfu_bot_"
+
+
+class Counter:
+	def __init__(self, name: str, description: str):
+		self.name: str = METRICS_PREFIX + name
+		self.description: str = description
+		# sorted (label, value) pairs -> value
+		self._values: dict[tuple[tuple[str, str], ...], float] = {}
+		_registry.append(self)
+
+	def inc(self, amount: float = 1, **labels: str) -> None:
+		key = _labels_key(labels)
+		self._values[key] = self._values.get(key, 0) + amount
+
+	def value(self, **labels: str) -> float:
+		return self._values.get(_labels_key(labels), 0)
+
+	def render(self) -> list[str]:
+		lines: list[str] = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+		for key, value in sorted(self._values.items()):
+			lines.append(f"{self.name}{_format_labels(key)} {value:g}")
+		return lines
+
+
+class Histogram:
+	def __init__(self, name: str, description: str, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+		self.name: str = METRICS_PREFIX + name
+		self.description: str = description
+		self.buckets: tuple[float, ...] = buckets
+		# sorted (label, value) pairs -> (count per bucket (NOT cumulative), total count, sum)
+		self._values: dict[tuple[tuple[str, str], ...], tuple[list[int], int, float]] = {}
+		_registry.append(self)
+
+	def observe(self, value: float, **labels: str) -> None:
+		key = _labels_key(labels)
+		bucket_counts, count, total = self._values.get(key, ([0] * len(self.buckets), 0, 0.0))
+		for i, upper_bound in enumerate(self.buckets):
+			if value <= upper_bound:
+				bucket_counts[i] += 1
+				break
+		self._values[key] = (bucket_counts, count + 1, total + value)
+
+	@contextmanager
+	def time(self, **labels: str) -> Iterator[None]:
+		"""Observes how long the block took (even if it raised)"""
+		started_at: float = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.observe(time.perf_counter() - started_at, **labels)
+
+	def stats(self) -> list[tuple[dict[str, str], int, float]]:
+		"""@return: List of (labels, count, sum)"""
+		return [(dict(key), count, total) for key, (_, count, total) in sorted(self._values.items())]
+
+	def render(self) -> list[str]:
+		lines: list[str] = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+		for key, (bucket_counts, count, total) in sorted(self._values.items()):
+			cumulative: int = 0
+			for upper_bound, bucket_count in zip(self.buckets, bucket_counts):
+				cumulative += bucket_count
+				lines.append(f"{self.name}_bucket{_format_labels(key + (('le', f'{upper_bound:g}'),))} {cumulative}")
+			lines.append(f"{self.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}")
+			lines.append(f"{self.name}_sum{_format_labels(key)} {total:g}")
+			lines.append(f"{self.name}_count{_format_labels(key)} {count}")
+		return lines
+
+
+_registry: list[Counter | Histogram] = []
+_runner: web.AppRunner | None = None
+
+
+# region    -- Metrics
+cache_lookups = Counter("cache_lookups_total", "Timetable cache lookups by cache and result (hit/stale/miss)")
+cache_puts = Histogram("cache_put_seconds", "Time spent putting entries into timetable cache (rendering included)")
+sfu_fetches = Histogram("sfu_fetch_seconds", "Time spent fetching timetable from SFU api by result (ok/failed)")
+renders = Histogram("render_seconds", "Time spent rendering timetable images")
+photo_sends = Histogram("send_photo_seconds", "Time spent sending timetable images by method (file_id/upload)")
+encodes = Histogram("encode_seconds", "Time spent encoding timetable images by encoding (see img_generator.encode)")
+encoded_bytes = Histogram(
+	"encoded_bytes", "Size of encoded timetable images by encoding",
+	buckets=(16 * 1024, 32 * 1024, 64 * 1024, 128 * 1024, 256 * 1024, 512 * 1024, 1024 * 1024, 5 * 1024 * 1024),
+)
+# endregion -- Metrics
+
+
+def render() -> str:
+	"""@return: All metrics in Prometheus text exposition format"""
+	lines: list[str] = []
+	for metric in _registry:
+		lines.extend(metric.render())
+	return "\n".join(lines) + "\n"
+
+
+def summary() -> str:
+	"""@return: Human-readable summary (for the admin panel)"""
+	lines: list[str] = []
+	for cache in ("day", "week", "timetable"):
+		hits: float = cache_lookups.value(cache=cache, result="hit")
+		stale: float = cache_lookups.value(cache=cache, result="stale")
+		misses: float = cache_lookups.value(cache=cache, result="miss")
+		total: float = hits + stale + misses
+		hit_rate: float = (hits + stale) / total * 100 if total else 0
+		lines.append(f"cache[{cache}]: {hit_rate:.1f}% hits ({hits:g} fresh, {stale:g} stale, {misses:g} misses)")
+
+	for histogram in (cache_puts, sfu_fetches, renders, encodes, photo_sends):
+		for labels, count, total in histogram.stats():
+			lines.append(f"{_describe(histogram, labels)}: {count} times, avg {total / count * 1000:.1f}ms")
+	for labels, count, total in encoded_bytes.stats():
+		lines.append(f"{_describe(encoded_bytes, labels)}: {count} images, avg {total / count / 1024:.1f}KiB")
+	return "\n".join(lines)
+
+
+def _describe(histogram: Histogram, labels: dict[str, str]) -> str:
+	labels_str: str = ", ".join(f"{name}={value}" for name, value in labels.items())
+	return f"{histogram.name.removeprefix(METRICS_PREFIX)}[{labels_str}]"
+
+
+async def start_server(host: str, port: int) -> None:
+	"""Serves render() at http://host:port/metrics (MUST be called from a running event loop)"""
+	global _runner
+
+	async def handle_metrics(_: web.Request) -> web.Response:
+		return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+	app = web.Application()
+	app.router.add_get("/metrics", handle_metrics)
+	_runner = web.AppRunner(app, access_log=None)
+	await _runner.setup()
+	try:
+		await web.TCPSite(_runner, host, port).start()
+	except OSError as err:
+		logging.error(f"Couldn't start metrics server on {host}:{port}: {err}")
+		await stop_server()
+		return
+	logging.info(f"Metrics are served at http://{host}:{port}/metrics")
+
+
+async def stop_server() -> None:
+	global _runner
+
+	if _runner is not None:
+		await _runner.cleanup()
+		_runner = None
+
+
+def _labels_key(labels: dict[str, str]) -> tuple[tuple[str, str], ...]:
+	return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def _format_labels(key: tuple[tuple[str, str], ...]) -> str:
+	if len(key) == 0:
+		return ""
+	escaped = (
+		(name, value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")) for name, value in key
+	)
+	return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
@@ -0,0 +1,147 @@
+# Shared http client for everything that talks to SFU services
+# (pooling, timeouts, retries and a circuit breaker, so one slow/dead upstream doesn't hang the bot)
+import asyncio
+import logging
+import random
+import time
+
+import aiohttp
+
+
+# region    -- Settings
+CONNECTOR_LIMIT: int = 64
+CONNECTOR_LIMIT_PER_HOST: int = 16
+DNS_CACHE_TTL_SECONDS: int = 60 * 10
+KEEPALIVE_TIMEOUT_SECONDS: int = 30
+TIMEOUT_TOTAL_SECONDS: float = 10
+TIMEOUT_CONNECT_SECONDS: float = 3
+# Total attempts per request (first one included)
+RETRY_ATTEMPTS: int = 3
+RETRY_BASE_DELAY_SECONDS: float = 0.25
+RETRY_MAX_DELAY_SECONDS: float = 2
+# Consecutive failed requests (after all retries) before SFU is considered down
+BREAKER_FAILURE_THRESHOLD: int = 5
+BREAKER_RESET_TIMEOUT_SECONDS: float = 30
+# endregion -- Settings
+
+
+class CircuitBreaker:
+	"""
+	Fails fast while upstream is down instead of making every user wait for timeouts:
+	closed -(N failures in a row)-> open -(reset timeout)-> half-open (1 probe request) -> closed/open
+	"""
+
+	def __init__(self, failure_threshold: int, reset_timeout: float):
+		self.failure_threshold: int = failure_threshold
+		self.reset_timeout: float = reset_timeout
+		self._failures: int = 0
+		self._opened_at: float | None = None
+		self._probing: bool = False
+
+	@property
+	def is_open(self) -> bool:
+		return self._opened_at is not None
+
+	def allow_request(self) -> bool:
+		if self._opened_at is None:
+			return True
+		# Half-open: let exactly one request through to check if upstream is alive again
+		if not self._probing and time.monotonic() - self._opened_at >= self.reset_timeout:
+			self._probing = True
+			return True
+		return False
+
+	def record_success(self) -> None:
+		if self._opened_at is not None:
+			logging.info("SFU API is back, closing circuit breaker")
+		self._failures = 0
+		self._opened_at = None
+		self._probing = False
+
+	def record_failure(self) -> None:
+		self._failures += 1
+		self._probing = False
+		if self._failures >= self.failure_threshold:
+			if self._opened_at is None:
+				logging.warning(f"SFU API failed {self._failures} times in a row, opening circuit breaker")
+			self._opened_at = time.monotonic()
+
+	def record_cancel(self) -> None:
+		"""Request was cancelled by the caller, so it proves nothing either way"""
+		self._probing = False
+
+
+_session: aiohttp.ClientSession | None = None
+breaker: CircuitBreaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT_SECONDS)
+
+
+def get_session() -> aiohttp.ClientSession:
+	"""
+	Session is created lazily on the running event loop (NOT at import time),
+	see close() for the other half of its lifecycle.
+	"""
+	global _session
+
+	if _session is None or _session.closed:
+		connector = aiohttp.TCPConnector(
+			limit=CONNECTOR_LIMIT,
+			limit_per_host=CONNECTOR_LIMIT_PER_HOST,
+			ttl_dns_cache=DNS_CACHE_TTL_SECONDS,
+			keepalive_timeout=KEEPALIVE_TIMEOUT_SECONDS,
+		)
+		_session = aiohttp.ClientSession(
+			connector=connector,
+			timeout=aiohttp.ClientTimeout(total=TIMEOUT_TOTAL_SECONDS, connect=TIMEOUT_CONNECT_SECONDS),
+		)
+	return _session
+
+
+async def get_json(url: str) -> dict | None:
+	"""
+	GET request with retries (jittered exponential backoff) guarded by the circuit breaker.
+	@return: Decoded json; None - if something went wrong (already logged)
+	"""
+	if not breaker.allow_request():
+		logging.warning(f"Circuit breaker is open, skipping SFU API call `{url}`")
+		return None
+
+	try:
+		for attempt in range(RETRY_ATTEMPTS):
+			if attempt != 0:
+				await asyncio.sleep(_backoff_delay(attempt))
+
+			try:
+				async with get_session().get(url) as response:
+					if response.status == 200:
+						json: dict = await response.json(content_type=None)
+						breaker.record_success()
+						return json
+					logging.error(f"Error {response.status} while calling SFU API `{url}`")
+					# Client errors won't magically fix themselves on retry
+					if response.status < 500 and response.status != 429:
+						breaker.record_success()
+						return None
+			except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+				if attempt + 1 < RETRY_ATTEMPTS:
+					logging.warning(f"Failed to call SFU API `{url}` (attempt {attempt + 1}): {e!r}")
+				else:
+					logging.error(f"Failed to call SFU API `{url}`", exc_info=e)
+	except asyncio.CancelledError:
+		breaker.record_cancel()
+		raise
+
+	breaker.record_failure()
+	return None
+
+
+def _backoff_delay(attempt: int) -> float:
+	# "Full jitter", so retries from many users don't hit upstream at the same moment
+	return random.uniform(0, min(RETRY_MAX_DELAY_SECONDS, RETRY_BASE_DELAY_SECONDS * 2 ** attempt))
+
+
+async def close() -> None:
+	global _session
+
+	if _session is not None:
+		await _session.close()
+		_session = None
@@ -1,107 +1,462 @@
 import logging
-from typing import Optional
+import sys
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Iterator, NamedTuple, Optional
 
-from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from . import img_generator
+import metrics
+from . import image_cache, img_generator, render_pool, store
 from .common import *
+from .lru import LRUCache
+from config import TIMETABLE_CACHE_MAX_AGE_MINUTES
 
 
 UPDATE_EVERY_N_MINUTES: int = 60 * 24
-cache_scheduler = BackgroundScheduler()
-# NOTE: Yeap, cache doesn't work with the theme selection. To be fair such option doesn't exist anyway, so...
-# (the real problem here is that cache holds raw strings to timetable images with no extra info...)
-# NOTE 2: The fact that cache is split into day cache and week cache is wierd, buuuuut it's good enough
-#  (as long as the note above isn't resolved)
-_global_day_cache: dict[
-	# (group: str, subgroup: str)
-	tuple[str, str],
-	dict[
-		# key - specific_week_num: int (ONLY either EVEN_DAY_NUM or ODD_DAY_NUM)
-		int,
-		# value - week timetable images
-		dict[
-			# key - day_num: int (from 0 to 6)
-			int,
-			# value - image
-			str
-		]
-	]
-] = {}
-_global_week_cache: dict[
-	# (group: str, subgroup: str)
-	tuple[str, str],
-	# key - specific_week_num: int (ONLY either EVEN_DAY_NUM or ODD_DAY_NUM)
-	# value - generated image
-	dict[int, str]
-] = {}
-
-
-def init_cache_scheduler() -> None:
+# Entries older than that are "stale": still served, but refreshed in the background
+FRESH_FOR_N_MINUTES: int = UPDATE_EVERY_N_MINUTES
+# Entries older than that are never served (last-known-good only goes so far...)
+MAX_AGE_N_MINUTES: int = TIMETABLE_CACHE_MAX_AGE_MINUTES
+# Users can type whatever group they want, so cache MUST be bounded
+MAX_CACHED_IMAGES: int = 10_000
+MAX_CACHED_IMAGES_BYTES: int = 512 * 1024 * 1024
+MAX_CACHED_TIMETABLES: int = 2_000
+MAX_CACHED_TIMETABLES_BYTES: int = 64 * 1024 * 1024
+# Replaced images aren't deleted right away, someone might be in the middle of sending them (see lease)
+RETIRED_IMAGES_GRACE_SECONDS: float = 60
+# NOTE: Cache is NOT thread-safe, everything MUST run on the bot's event loop.
+# That includes scheduler jobs: AsyncIOScheduler runs plain functions in a thread pool, so jobs MUST be coroutines
+cache_scheduler = AsyncIOScheduler()
+
+
+class CacheKey(NamedTuple):
+	group: str
+	subgroup: str
+	# ONLY either WeekNum.ODD or WeekNum.EVEN
+	week_num: int
+	# From 0 to 6; None - whole week
+	day_num: int | None
+	# See img_generator.COLOR_SCHEMA
+	theme: str
+
+
+@dataclass
+class CachedImage:
+	path: str
+	# When timetable this image was generated from was fetched (see Timetable.fetched_at)
+	fetched_at: float
+
+
+def _image_size(image: CachedImage) -> int:
+	# Placeholders are assets, they don't take any extra space
+	if img_generator.is_placeholder(image.path):
+		return 0
+	return image_cache.size(image.path)
+
+
+def _timetable_size(timetable: Timetable) -> int:
+	# Rough estimate, but good enough for a budget
+	return sum(
+		sys.getsizeof(value)
+		for days in timetable.weeks.values()
+		for day in days
+		for lesson in day.lessons
+		for value in vars(lesson).values()
+	)
+
+
+def _on_image_evicted(key: CacheKey, image: CachedImage) -> None:
+	_unindex_image(key)
+	_release_image_file(image.path)
+	store.delete_image(*_store_key(key))
+
+
+def _on_timetable_evicted(key: tuple[str, str], _: Timetable) -> None:
+	store.delete_timetable(*key)
+
+
+_global_image_cache: LRUCache[CacheKey, CachedImage] = LRUCache(
+	MAX_CACHED_IMAGES, MAX_CACHED_IMAGES_BYTES, MAX_AGE_N_MINUTES * 60, _image_size, _on_image_evicted
+)
+# Parsed timetables (everything from one SFU api call) that images above are generated from
+_global_timetable_cache: LRUCache[tuple[str, str], Timetable] = LRUCache(
+	MAX_CACHED_TIMETABLES, MAX_CACHED_TIMETABLES_BYTES, MAX_AGE_N_MINUTES * 60,
+	_timetable_size, _on_timetable_evicted
+)
+# (group, subgroup) -> keys of all cached images of that group, so per-group lookups don't scan the whole cache
+# (see cached_images_for); kept in sync with _global_image_cache by _put_image and _on_image_evicted
+_group_image_keys: dict[tuple[str, str], set[CacheKey]] = {}
+# Images are content-addressed (see img_generator.day_path), so one file can be shared by many entries:
+# path -> number of entries pointing to it (file is deleted only when nothing points to it)
+_image_file_refs: dict[str, int] = {}
+# path -> number of sends in progress (see lease)
+_image_file_leases: dict[str, int] = {}
+# path -> time.time() when it was retired (i.e. nothing in cache points to it anymore)
+_retired_image_files: dict[str, float] = {}
+
+
+def init_cache_scheduler(refresh_job: Callable[[], Awaitable[None]]) -> None:
+	"""
+	MUST be called from the running event loop.
+	@param refresh_job: Builds next cache generation and swaps it in (see swap_generation)
+	"""
 	cache_scheduler.add_job(
-		reset_global_cache, "interval",
+		refresh_job, "interval",
 		minutes=UPDATE_EVERY_N_MINUTES, id="timetable_cache_update"
 	)
+	cache_scheduler.add_job(
+		_expire_global_cache_job, "interval",
+		minutes=UPDATE_EVERY_N_MINUTES, id="timetable_cache_expire"
+	)
 	cache_scheduler.start()
-	reset_global_cache()
+
+
+def load_persisted_cache() -> None:
+	"""Restores cache from the store (so restarts start warm), everything invalid is thrown away"""
+	store.init_store()
+
+	for group, subgroup, raw_json, fetched_at in store.load_timetables():
+		if _is_too_old(fetched_at):
+			store.delete_timetable(group, subgroup)
+			continue
+		try:
+			timetable: Timetable = Timetable.from_json(group, subgroup, raw_json)
+		except (TypeError, ValueError) as err:
+			logging.warning(f"Persisted timetable for `{group}` ({subgroup}) is broken: {err}")
+			store.delete_timetable(group, subgroup)
+			continue
+		timetable.fetched_at = fetched_at
+		_global_timetable_cache.put((group, subgroup), timetable, fetched_at)
+
+	for group, subgroup, week_num, day_num, theme, path, fetched_at in store.load_images():
+		key = CacheKey(group, subgroup, week_num, None if day_num == store.WEEK_DAY_NUM else day_num, theme)
+		timetable: Timetable | None = _global_timetable_cache.get((group, subgroup))
+		if (
+			timetable is None
+			or _is_too_old(fetched_at)
+			# Rendered before a visual change (see img_generator.RENDER_VERSION)
+			or path != _image_path_for(timetable, key)
+			or not image_cache.contains(path)
+		):
+			store.delete_image(group, subgroup, week_num, day_num, theme)
+			continue
+
+		_put_image(key, CachedImage(path, fetched_at), persist=False)
+
+	# Leftovers that nothing points to (+ whatever didn't fit into the budget)
+	image_cache.delete_all(keep={image.path for _, image in _global_image_cache.items()})
+	logging.info(f"Timetable cache restored: {stats()}")
+
+
+def _image_path_for(timetable: Timetable, key: CacheKey) -> str:
+	"""@return: Where image for that key would be rendered to right now"""
+	dark_theme: bool = key.theme == "dark"
+	if key.day_num is None:
+		return img_generator.week_path(timetable.week(key.week_num), dark_theme)
+	return img_generator.day_path(timetable.day(key.week_num, key.day_num), dark_theme)
 
 
 def reset_global_cache() -> None:
+	"""Wipes EVERYTHING (including last-known-good timetables), see expire_global_cache for the soft variant"""
 	# Note: It's tempting to re-parse and re-generate all the data based on previous entries.
-	# However at some point old (group, subgroup) entries inside _global_day_cache might become obsolete,
+	# However at some point old (group, subgroup) entries inside _global_image_cache might become obsolete,
 	# parsing incorrect data again, again and again + keeping garbage data around...
 	# SO NEVER EVER DO THAT!
-	global _global_day_cache, _global_week_cache
-	
-	_global_day_cache.clear()
-	_global_week_cache.clear()
-	img_generator.delete_all()
+	paths: set[str] = {image.path for _, image in _global_image_cache.items()}
+	_global_image_cache.clear()
+	_global_timetable_cache.clear()
+	_group_image_keys.clear()
+	_image_file_refs.clear()
+	store.clear()
+	# Files might still be in use, so they're retired instead of being deleted right away
+	for path in paths:
+		_retire_image_file(path)
 
 
-def try_get_day(group: str, subgroup: str, week_num: int, day_index: int) -> str | None:
+def invalidate(group: str, subgroup: str | None = None) -> int:
+	"""
+	Drops everything cached for that group (all subgroups if subgroup is None).
+	@return: Number of dropped entries
+	"""
+	dropped: int = 0
+	for key in _global_timetable_cache.keys():
+		if key[0] == group and (subgroup is None or key[1] == subgroup):
+			_global_timetable_cache.pop(key)
+			dropped += 1
+
+	for group_key in list(_group_image_keys.keys()):
+		if group_key[0] == group and (subgroup is None or group_key[1] == subgroup):
+			for key, _ in cached_images_for(*group_key):
+				_global_image_cache.pop(key)
+				dropped += 1
+
+	logging.info(f"Timetable cache for `{group}` ({subgroup or 'all subgroups'}) invalidated: {dropped} entries")
+	return dropped
+
+
+def expire_global_cache() -> None:
+	"""
+	Deletes entries older than MAX_AGE_N_MINUTES. Everything else is kept around as
+	last-known-good data in case SFU api is down (stale entries are refreshed on demand, see parser).
+	"""
+	expired: int = _global_timetable_cache.expire() + _global_image_cache.expire()
+	_sweep_retired_image_files()
+	logging.info(f"Timetable cache expired, {expired} entries were too old and got deleted")
+
+
+async def _expire_global_cache_job() -> None:
+	# Coroutine, so the scheduler runs it on the event loop (see cache_scheduler)
+	expire_global_cache()
+
+
+def cached_groups() -> list[tuple[str, str]]:
+	"""@return: All (group, subgroup) pairs with cached timetable"""
+	return _global_timetable_cache.keys()
+
+
+def cached_images_for(group: str, subgroup: str) -> list[tuple[CacheKey, CachedImage]]:
+	"""Note: Doesn't count as usage (see LRUCache.peek)"""
+	return [(key, _global_image_cache.peek(key)) for key in _group_image_keys.get((group, subgroup), ())]
+
+
+def swap_generation(
+	timetables: list[tuple[Timetable, dict]], images: dict[CacheKey, CachedImage]
+) -> None:
+	"""
+	Atomically (nothing is awaited here) replaces live cache entries with the next generation
+	that was built alongside them. Replaced images are retired, not deleted (see lease).
+	Only memory is touched here, the generation is persisted in the background (as one transaction).
+	@param timetables: List of (timetable, raw_json) - see put_timetable
+	"""
+	for timetable, _ in timetables:
+		_global_timetable_cache.put((timetable.for_group, timetable.for_subgroup), timetable, timetable.fetched_at)
+
+	for key, image in images.items():
+		# Reused file might've been retired and swept while the generation was being built
+		if not image_cache.contains(image.path):
+			logging.warning(f"Image `{image.path}` from the new generation is gone, {key} will be rendered on demand")
+			_global_image_cache.pop(key)
+			continue
+		_put_image(key, image, persist=False)
+
+	# Whatever didn't survive the swap (e.g. evicted to fit the budget) is already deleted from the store
+	store.save_generation(
+		[
+			(timetable.for_group, timetable.for_subgroup, raw_json, timetable.fetched_at)
+			for timetable, raw_json in timetables
+			if _global_timetable_cache.peek((timetable.for_group, timetable.for_subgroup)) is timetable
+		],
+		[
+			(*_store_key(key), image.path, image.fetched_at)
+			for key, image in images.items()
+			if _global_image_cache.peek(key) is image
+		],
+	)
+
+	logging.info(f"New timetable cache generation: {len(timetables)} timetables, {len(images)} images")
+
+
+@contextmanager
+def lease(path: str) -> Iterator[None]:
+	"""Image at path won't be deleted while it's leased (e.g. while it's being uploaded)"""
+	_image_file_leases[path] = _image_file_leases.get(path, 0) + 1
+	try:
+		yield
+	finally:
+		leases: int = _image_file_leases[path] - 1
+		if leases > 0:
+			_image_file_leases[path] = leases
+		else:
+			del _image_file_leases[path]
+			_sweep_retired_image_files()
+
+
+def stats() -> dict[str, int]:
+	return {
+		"images": len(_global_image_cache),
+		"images_bytes": _global_image_cache.bytes,
+		"timetables": len(_global_timetable_cache),
+		"timetables_bytes": _global_timetable_cache.bytes,
+	}
+
+
+def is_fresh(fetched_at: float) -> bool:
+	return time.time() - fetched_at < FRESH_FOR_N_MINUTES * 60
+
+
+def _is_too_old(fetched_at: float) -> bool:
+	return time.time() - fetched_at >= MAX_AGE_N_MINUTES * 60
+
+
+def _store_key(key: CacheKey) -> tuple[str, str, int, int, str]:
+	day_num: int = store.WEEK_DAY_NUM if key.day_num is None else key.day_num
+	return key.group, key.subgroup, key.week_num, day_num, key.theme
+
+
+def try_get_day(
+	group: str, subgroup: str, week_num: int, day_index: int, theme: str = DEFAULT_THEME, count: bool = True
+) -> CachedImage | None:
 	"""
 	@param week_num: MUST be either EVEN_DAY_NUM or ODD_DAY_NUM
+	@param count: Whether lookup counts towards cache metrics (re-checks of the same lookup shouldn't)
+	@return: Cached image (might be stale, see is_fresh); None - if there is nothing to serve
 	"""
-	week_data: dict[int, str] | None = _global_day_cache.get((group, subgroup), {}).get(week_num, None)
-	if week_data is None:
-		return None
-	
-	# week_data isn't guaranteed to have data for ALL days
-	return week_data.get(day_index, None)
+	cached: CachedImage | None = _get_image(CacheKey(group, subgroup, week_num, day_index, theme))
+	if count:
+		_count_lookup("day", None if cached is None else cached.fetched_at)
+	return cached
+
+
+def try_get_timetable(group: str, subgroup: str, count: bool = True) -> Timetable | None:
+	"""
+	@param count: See try_get_day
+	@return: Cached timetable (might be stale, see is_fresh); None - if there is nothing to serve
+	"""
+	cached: Timetable | None = _global_timetable_cache.get((group, subgroup))
+	if count:
+		_count_lookup("timetable", None if cached is None else cached.fetched_at)
+	return cached
 
 
-def try_get_week(group: str, subgroup: str, week_num: int) -> str | None:
+def try_get_week(
+	group: str, subgroup: str, week_num: int, theme: str = DEFAULT_THEME, count: bool = True
+) -> CachedImage | None:
 	"""
 	@param week_num: MUST be either EVEN_DAY_NUM or ODD_DAY_NUM
+	@param count: See try_get_day
+	@return: Cached image (might be stale, see is_fresh); None - if there is nothing to serve
 	"""
-	return _global_week_cache.get((group, subgroup), {}).get(week_num, None)
+	cached: CachedImage | None = _get_image(CacheKey(group, subgroup, week_num, None, theme))
+	if count:
+		_count_lookup("week", None if cached is None else cached.fetched_at)
+	return cached
+
 
+def _get_image(key: CacheKey) -> CachedImage | None:
+	cached: CachedImage | None = _global_image_cache.get(key)
+	# Image itself might've been evicted by image_cache (e.g. disk quota), then it's simply rendered again
+	if cached is not None and not image_cache.contains(cached.path):
+		_global_image_cache.pop(key)
+		return None
+	return cached
+
+
+def _count_lookup(cache: str, fetched_at: float | None) -> None:
+	result: str = "miss"
+	if fetched_at is not None:
+		result = "hit" if is_fresh(fetched_at) else "stale"
+	metrics.cache_lookups.inc(cache=cache, result=result)
 
-def put_week(days: list[Day]) -> str:
-	"""@return: Path to timetable image added to the cache"""
-	global _global_week_cache
 
-	key: tuple[str, str] = (days[0].for_group, days[0].for_subgroup)
-	if key not in _global_week_cache:
-		_global_week_cache[key] = {}
+def put_timetable(timetable: Timetable, raw_json: dict) -> Timetable:
+	"""
+	@param raw_json: SFU api response timetable was parsed from (that's what gets persisted)
+	@return: Timetable added to the cache
+	"""
+	with metrics.cache_puts.time(cache="timetable"):
+		key: tuple[str, str] = (timetable.for_group, timetable.for_subgroup)
+		previous: Timetable | None = _global_timetable_cache.get(key)
+		_global_timetable_cache.put(key, timetable, timetable.fetched_at)
+		store.save_timetable(timetable.for_group, timetable.for_subgroup, raw_json, timetable.fetched_at)
+
+		if previous is not None:
+			_revalidate_images(key, timetable.changed_days(previous), timetable.fetched_at)
+	return timetable
 
-	new_img: str = img_generator.generate_week(days)
-	_global_week_cache[key][days[0].week_num] = new_img
+
+def _revalidate_images(group_key: tuple[str, str], changed_days: set[tuple[int, int]], fetched_at: float) -> None:
+	"""
+	Images of days that didn't change are still valid, so they're simply marked as fresh.
+	Only images of changed days (and weeks with those days) are deleted and re-rendered later.
+	"""
+	for key, image in cached_images_for(*group_key):
+		if is_changed(key, changed_days):
+			_global_image_cache.pop(key)
+		else:
+			_put_image(key, CachedImage(image.path, fetched_at))
+
+	if len(changed_days) != 0:
+		logging.info(
+			f"Timetable for `{group_key[0]}` ({group_key[1]}) changed: {len(changed_days)} days will be re-rendered"
+		)
+
+
+def is_changed(key: CacheKey, changed_days: set[tuple[int, int]]) -> bool:
+	"""@param changed_days: See Timetable.changed_days"""
+	if key.day_num is None:
+		return any(week_num == key.week_num for week_num, _ in changed_days)
+	return (key.week_num, key.day_num) in changed_days
+
+
+async def put_week(days: list[Day], fetched_at: float, theme: str = DEFAULT_THEME) -> str:
+	"""
+	@param fetched_at: When timetable for these days was fetched (see Timetable.fetched_at)
+	@return: Path to timetable image added to the cache
+	"""
+	with metrics.cache_puts.time(cache="week"):
+		new_img: str = await render_pool.render_week(days, dark_theme=theme == "dark")
+		key = CacheKey(days[0].for_group, days[0].for_subgroup, days[0].week_num, None, theme)
+		_put_image(key, CachedImage(new_img, fetched_at))
 	return new_img
 
 
-def put_day(day: Day) -> str:
-	"""@return: Path to timetable image added to the cache"""
-	global _global_day_cache
-	
-	key: tuple[str, str] = (day.for_group, day.for_subgroup)
-
-	if key not in _global_day_cache:
-		_global_day_cache[key] = {}
-	
-	if day.week_num not in _global_day_cache[key]:
-		_global_day_cache[key][day.week_num] = {}
-	
-	new_img: str = img_generator.generate_day(day)
-	_global_day_cache[key][day.week_num][day.day_num] = new_img
+async def put_day(day: Day, fetched_at: float, theme: str = DEFAULT_THEME) -> str:
+	"""
+	@param fetched_at: When timetable for this day was fetched (see Timetable.fetched_at)
+	@return: Path to timetable image added to the cache
+	"""
+	with metrics.cache_puts.time(cache="day"):
+		new_img: str = await render_pool.render_day(day, dark_theme=theme == "dark")
+		key = CacheKey(day.for_group, day.for_subgroup, day.week_num, day.day_num, theme)
+		_put_image(key, CachedImage(new_img, fetched_at))
 	return new_img
+
+
+def _put_image(key: CacheKey, image: CachedImage, persist: bool = True) -> None:
+	previous: CachedImage | None = _global_image_cache.peek(key)
+	_image_file_refs[image.path] = _image_file_refs.get(image.path, 0) + 1
+	_group_image_keys.setdefault((key.group, key.subgroup), set()).add(key)
+	_global_image_cache.put(key, image, image.fetched_at)
+	# Replaced entries aren't "evicted", so the old file has to be released here
+	if previous is not None:
+		_release_image_file(previous.path)
+
+	if persist:
+		store.save_image(*_store_key(key), image.path, image.fetched_at)
+
+
+def _unindex_image(key: CacheKey) -> None:
+	keys: set[CacheKey] | None = _group_image_keys.get((key.group, key.subgroup), None)
+	if keys is None:
+		return
+	keys.discard(key)
+	if len(keys) == 0:
+		del _group_image_keys[(key.group, key.subgroup)]
+
+
+def _release_image_file(path: str) -> None:
+	refs: int = _image_file_refs.get(path, 0) - 1
+	if refs > 0:
+		_image_file_refs[path] = refs
+		return
+
+	_image_file_refs.pop(path, None)
+	_retire_image_file(path)
+
+
+def _retire_image_file(path: str) -> None:
+	_retired_image_files[path] = time.time()
+	_sweep_retired_image_files()
+
+
+def _sweep_retired_image_files() -> None:
+	now: float = time.time()
+	for path, retired_at in list(_retired_image_files.items()):
+		# Content-addressed files can come back to life (same content was rendered again)
+		if _image_file_refs.get(path, 0) > 0:
+			del _retired_image_files[path]
+		elif _image_file_leases.get(path, 0) == 0 and now - retired_at >= RETIRED_IMAGES_GRACE_SECONDS:
+			del _retired_image_files[path]
+			image_cache.delete(path)
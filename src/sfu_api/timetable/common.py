@@ -1,10 +1,18 @@
 # Types, constants and other stuff shared by sfu_api/timetable
 # (not perfect, but good enough)
-from dataclasses import dataclass
+import hashlib
+import json as json_lib
+import logging
+import time
+from dataclasses import asdict, dataclass, field
 from datetime import datetime
 from enum import StrEnum, IntEnum
 
 
+# See img_generator.COLOR_SCHEMA for all themes
+DEFAULT_THEME: str = "dark"
+
+
 class WeekNum(IntEnum):
 	ODD = 1
 	EVEN = 2
@@ -64,6 +72,74 @@ class Day:
 	for_subgroup: int
 	lessons: list[Lesson]
 
+	def is_day_off(self) -> bool:
+		# Нет пар или воскресенье
+		return self.day_num == 6 or len(self.lessons) == 0
+
+	def content_hash(self) -> str:
+		"""Hash of everything that ends up on the image (but not the group!)"""
+		normalized: list[dict] = [
+			{name: str(value).strip() for name, value in asdict(lesson).items()} for lesson in self.lessons
+		]
+		data: str = json_lib.dumps([self.day_num, normalized], ensure_ascii=False, sort_keys=True)
+		return hashlib.sha256(data.encode()).hexdigest()
+
+
+@dataclass
+class Timetable:
+	"""Whole timetable of a (group, subgroup): both week parities, all 7 days (parsed once per fetch)"""
+	for_group: str
+	for_subgroup: str
+	# key - specific week num (ONLY either WeekNum.ODD or WeekNum.EVEN)
+	# value - 7 days of that week (index == day_num)
+	weeks: dict[int, list[Day]]
+	# time.time() of the SFU api call this timetable came from
+	fetched_at: float = field(default_factory=time.time)
+
+	def day(self, week_num: int, day_num: int) -> Day:
+		return self.weeks[week_num][day_num]
+
+	def changed_days(self, other: "Timetable") -> set[tuple[int, int]]:
+		"""@return: (week_num, day_num) of all days that differ between self and other"""
+		return {
+			(week_num, day.day_num)
+			for week_num, days in self.weeks.items()
+			for day in days
+			if day.content_hash() != other.day(week_num, day.day_num).content_hash()
+		}
+
+	def week(self, week_num: int) -> list[Day]:
+		# Sunday is only included if there is actually something to show
+		days: list[Day] = self.weeks[week_num]
+		if len(days[6].lessons) == 0:
+			return days[:6]
+		return days
+
+	@classmethod
+	def from_json(cls, group: str, subgroup: str, json: dict):
+		weeks: dict[int, list[Day]] = {
+			week_num: [Day(day_num, week_num, group, subgroup, []) for day_num in range(7)]
+			for week_num in (WeekNum.ODD, WeekNum.EVEN)
+		}
+		for item in json.get("timetable", []):
+			item: dict
+			# Note: Sfu api counts days from 1 (Monday)
+			day_num: int = int(item.get("day", 0)) - 1
+			if not 0 <= day_num <= 6:
+				logging.warning(f"Unexpected day in SFU timetable for `{group}` ({subgroup}): {item}")
+				continue
+
+			week: str = str(item.get("week", "1"))
+			lesson: Lesson = Lesson.from_json(item)
+			# Lessons without (known) week happen every week
+			if week == str(int(WeekNum.ODD)) or week == str(int(WeekNum.EVEN)):
+				weeks[int(week)][day_num].lessons.append(lesson)
+			else:
+				for days in weeks.values():
+					days[day_num].lessons.append(lesson)
+
+		return Timetable(group, subgroup, weeks)
+
 
 def day_num_to_str(num: int) -> str:
 	match num:
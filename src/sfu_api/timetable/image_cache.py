@@ -0,0 +1,225 @@
+# Encoded timetable images are kept in memory (that's what gets uploaded to Telegram),
+# disk is an optional spill tier (see TIMETABLE_IMAGES_ON_DISK), so restarts don't lose them.
+# Images are identified by their content-addressed paths (see img_generator.day_path), even if never written.
+# NOTE: Disk reads/writes/deletes happen in a background thread, so sending/rendering/cleanup never block the event loop
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Collection
+
+from . import img_generator
+from .lru import LRUCache
+from config import TIMETABLE_IMAGES_DISK_QUOTA_BYTES, TIMETABLE_IMAGES_ON_DISK
+
+
+SPILL_TO_DISK: bool = TIMETABLE_IMAGES_ON_DISK
+# With disk to fall back to only hot images stay in memory
+MAX_MEMORY_BYTES: int = 128 * 1024 * 1024
+MAX_DISK_BYTES: int = TIMETABLE_IMAGES_DISK_QUOTA_BYTES
+TMP_SUFFIX: str = ".tmp"
+
+# path -> encoded image. Without disk memory is the only copy, so nothing is evicted
+# (number of images is already bounded by cacher, unused ones are deleted from here)
+_images: LRUCache[str, bytes] = LRUCache(
+	sys.maxsize, MAX_MEMORY_BYTES if SPILL_TO_DISK else sys.maxsize, float("inf"), len
+)
+# path -> file size, least recently used first (see _get_disk_index)
+_disk_index: LRUCache[str, int] | None = None
+# path -> encoded image that is queued to be written (reads shouldn't miss it in the meantime)
+_pending_writes: dict[str, bytes] = {}
+# Single thread, so writes/deletes of the same path happen in the same order they were queued
+_disk_io = ThreadPoolExecutor(1, thread_name_prefix="image-disk")
+
+
+def _get_disk_index() -> LRUCache[str, int]:
+	"""Disk index is built lazily from whatever is on disk (e.g. after a restart)"""
+	global _disk_index
+
+	if _disk_index is None:
+		_disk_index = LRUCache(sys.maxsize, MAX_DISK_BYTES, float("inf"), lambda file_size: file_size, _on_disk_evicted)
+		if SPILL_TO_DISK:
+			files: list[tuple[float, str, int]] = _scan_disk()
+			# Oldest first, so the least recently used ones are evicted first
+			for _, path, file_size in sorted(files):
+				_disk_index.put(path, file_size)
+			logging.info(
+				f"Timetable images on disk: {len(_disk_index)} files, {_disk_index.bytes / 1024 / 1024:.1f}MiB "
+				f"(quota {MAX_DISK_BYTES / 1024 / 1024:.0f}MiB)"
+			)
+	return _disk_index
+
+
+def contains(path: str) -> bool:
+	if _images.peek(path) is not None:
+		return True
+	if img_generator.is_placeholder(path):
+		return os.path.isfile(path)
+	return SPILL_TO_DISK and _get_disk_index().peek(path) is not None
+
+
+async def get(path: str) -> bytes | None:
+	"""
+	Images that aren't in memory are read from disk in the disk thread, not on the event loop
+	@return: Encoded image; None - if there is no such image
+	"""
+	data: bytes | None = _images.get(path) or _pending_writes.get(path, None)
+	if data is not None:
+		return data
+	if not SPILL_TO_DISK and not img_generator.is_placeholder(path):
+		return None
+
+	data = await asyncio.get_running_loop().run_in_executor(_disk_io, _read, path)
+	if img_generator.is_placeholder(path):
+		if data is not None:
+			_images.put(path, data)
+		return data
+
+	if data is None:
+		# Might've been put while it was being read, otherwise it was deleted behind our back
+		data = _images.get(path) or _pending_writes.get(path, None)
+		if data is None:
+			_get_disk_index().pop(path)
+		return data
+	# Might've been deleted while it was being read, then it shouldn't come back to life in memory
+	if _get_disk_index().get(path) is not None:
+		# Access time is what LRU order is restored from after a restart
+		_disk_io.submit(_touch, path)
+		_images.put(path, data)
+	return data
+
+
+def put(path: str, data: bytes) -> None:
+	_images.put(path, data)
+	if SPILL_TO_DISK:
+		_pending_writes[path] = data
+		# Might evict least recently used files (see _on_disk_evicted)
+		_get_disk_index().put(path, len(data))
+		_disk_io.submit(_write_atomically, path, data)
+
+
+def size(path: str) -> int:
+	if img_generator.is_placeholder(path):
+		# Static files, so the size doesn't depend on whether they're currently in memory
+		try:
+			return os.path.getsize(path)
+		except OSError:
+			return 0
+	data: bytes | None = _images.peek(path)
+	if data is not None:
+		return len(data)
+	if not SPILL_TO_DISK:
+		return 0
+	return _get_disk_index().peek(path) or 0
+
+
+def fingerprint(path: str) -> str | None:
+	"""@return: Anything that changes when image at path changes; None - if there is no such image"""
+	if not contains(path):
+		return None
+	# Images are content-addressed (different content == different path), the size is just a sanity check
+	return str(size(path))
+
+
+def delete(path: str) -> None:
+	"""Deletes generated image (placeholders and missing images are ignored)"""
+	if img_generator.is_placeholder(path):
+		return
+	_images.pop(path)
+	if SPILL_TO_DISK:
+		# File itself is deleted in the background (see _on_disk_evicted)
+		_get_disk_index().pop(path)
+
+
+def delete_all(keep: Collection[str] = ()) -> None:
+	"""
+	Deletes all generated images (in the background, nothing waits for the files to be actually deleted)
+	@param keep: Paths to images that shouldn't be deleted
+	"""
+	for path in _images.keys():
+		if path not in keep:
+			_images.pop(path)
+	if SPILL_TO_DISK:
+		disk_index: LRUCache[str, int] = _get_disk_index()
+		for path in disk_index.keys():
+			if path not in keep:
+				disk_index.pop(path)
+
+
+def flush() -> None:
+	"""Waits until all queued disk writes/deletes are done (e.g. before shutdown)"""
+	_disk_io.submit(lambda: None).result()
+
+
+def _on_disk_evicted(path: str, _: int) -> None:
+	_pending_writes.pop(path, None)
+	_disk_io.submit(_remove, path)
+
+
+def _scan_disk() -> list[tuple[float, str, int]]:
+	"""@return: List of (last access time, path, size) of all images on disk"""
+	files: list[tuple[float, str, int]] = []
+	pending: list[str] = [img_generator.IMG_OUTPUT_DIR]
+	while len(pending) != 0:
+		try:
+			entries: list[os.DirEntry] = list(os.scandir(pending.pop()))
+		except OSError:
+			continue
+		for entry in entries:
+			if entry.is_dir(follow_symlinks=False):
+				pending.append(entry.path)
+			elif entry.name.endswith(TMP_SUFFIX):
+				# Leftover from a crash in the middle of a write
+				_disk_io.submit(_remove, entry.path)
+			else:
+				stat = entry.stat(follow_symlinks=False)
+				# Filesystems mounted with noatime never update access time
+				files.append((max(stat.st_atime, stat.st_mtime), entry.path, stat.st_size))
+	return files
+
+
+# region    -- Disk thread
+def _write_atomically(path: str, data: bytes) -> None:
+	"""Readers (e.g. after a restart) should never see a half-written file"""
+	tmp_path: str = f"{path}.{os.getpid()}.{threading.get_ident()}{TMP_SUFFIX}"
+	try:
+		os.makedirs(os.path.dirname(path), exist_ok=True)
+		with open(tmp_path, mode="wb") as file:
+			file.write(data)
+			# Otherwise after a power loss the renamed file might turn out to be empty
+			file.flush()
+			os.fsync(file.fileno())
+		os.replace(tmp_path, path)
+	except OSError as err:
+		logging.error(f"Couldn't write timetable image `{path}`: {err}")
+	finally:
+		_pending_writes.pop(path, None)
+
+
+def _read(path: str) -> bytes | None:
+	try:
+		with open(path, mode="rb") as file:
+			return file.read()
+	except OSError:
+		return None
+
+
+def _touch(path: str) -> None:
+	try:
+		# Only access time, modification time is left as is
+		os.utime(path, ns=(time.time_ns(), os.stat(path).st_mtime_ns))
+	except OSError:
+		pass
+
+
+def _remove(path: str) -> None:
+	try:
+		os.remove(path)
+	except FileNotFoundError:
+		pass
+	except OSError as err:
+		logging.error(f"Couldn't delete timetable image `{path}`: {err}")
+# endregion -- Disk thread
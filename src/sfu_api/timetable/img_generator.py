@@ -1,11 +1,16 @@
+import functools
+import hashlib
+import io
 import os
 import logging
-import textwrap
+import time
+from typing import Callable, NamedTuple
 
 from PIL import Image, ImageDraw, ImageFont
 from PIL.Image import Image as ImageType
 
 from .common import *
+from config import TIMETABLE_IMAGE_BYTES_BUDGET, TIMETABLE_IMAGE_FORMAT
 
 
 IMG_DIR_ROOT: str = os.path.join(os.getcwd(), "_timetable_images")
@@ -33,23 +38,121 @@ LESSON_TYPE_COLORS = {
 	LessonType.LAB: "#d01eb2"
 }
 FONT_PATH: str = os.path.join(IMG_ASSETS_DIR, "Roboto-Medium.ttf")
+DAY_FONT_SIZE: int = 24
+TITLE_FONT_SIZE: int = 18
+DEFAULT_FONT_SIZE: int = 14
 PLACEHOLDER_IMG_LIGHT: str = os.path.join(IMG_ASSETS_DIR, "default_img_light.png")
 PLACEHOLDER_IMG_DARK: str = os.path.join(IMG_ASSETS_DIR, "default_img_dark.png")
 # Base/Initial vertical offset
 BASE_HEIGHT: int = 32
 # Base/Initial horizontal offset
 BASE_WIDTH: int = 5
-# Max length for text (in columns) before wrapping (see textwrap.wrap)
-MAX_WIDTH_COLUMNS: int = 48
+# Width can be a constant value thanks to text wrapping (see _layout_text)
+IMG_WIDTH: int = 768
+# Same lesson names/teachers/locations show up in thousands of renders (see _layout_text)
+LAYOUT_CACHE_SIZE: int = 8192
+# Static pieces (day names, lesson types, sync statuses) x themes, there aren't many of them (see _get_sprite)
+SPRITE_CACHE_SIZE: int = 512
 OFFSET_BETWEEN_LESSONS: int = 24
 # Offset between lesson's "parts" (rows): name, time, location, teacher, etc.
 OFFSET_BETWEEN_ROWS: int = 10
-EXPECTED_ROWS_PER_LESSON: int = 5
+# Blank space below the last row (also separates days in week images)
+BOTTOM_PADDING: int = 24
+# Images are mostly flat colors + anti-aliased text, full color PNG is a waste (see encode)
+IMAGE_FORMAT: str = TIMETABLE_IMAGE_FORMAT
+IMAGE_EXTENSION: str = "webp" if IMAGE_FORMAT == "webp" else "png"
+IMAGE_BYTES_BUDGET: int = TIMETABLE_IMAGE_BYTES_BUDGET
+# Palette sizes tried one by one until the image fits into the budget
+PALETTE_COLORS: tuple[int, ...] = (256, 64, 16)
+# Bump on any visual change that isn't a constant above (e.g. layout code), otherwise images that are
+# already rendered (and their Telegram file ids) keep being reused for unchanged timetables, see day_path
+RENDER_VERSION: int = 1
+# font size -> font; fonts are loaded once per process (see preload_fonts)
+_fonts: dict[int, ImageFont.FreeTypeFont] = {}
+# dark_theme -> decoded placeholder image (loaded once per process too)
+_placeholders: dict[bool, ImageType] = {}
+
+
+class EncodedImage(NamedTuple):
+	data: bytes
+	# What was actually used, e.g. "png-palette64" (see _encoders)
+	encoding: str
+	seconds: float
+
+
+class _TextLayout(NamedTuple):
+	lines: tuple[str, ...]
+	width: int
+	# Distance between baselines of two lines
+	line_height: int
+	# How far text goes below the baseline
+	descent: int
+
+	@property
+	def height(self) -> int:
+		return len(self.lines) * self.line_height
+
+
+class _TextBlock(NamedTuple):
+	layout: _TextLayout
+	font_size: int
+	x: int
+	# Baseline of the first line
+	y: int
+	color: str
+	# Same text shows up in every render, so it's pasted from a pre-rendered sprite (see _get_sprite)
+	static: bool = False
+
+	@property
+	def bottom(self) -> int:
+		return self.y + (len(self.layout.lines) - 1) * self.layout.line_height + self.layout.descent
 
 
 # region   -- Drawing
-def _concat_images(images_paths: list[str], dark_theme: bool) -> ImageType:
-	images: list[ImageType] = [Image.open(path) for path in images_paths]
+def _get_font(size: int) -> ImageFont.FreeTypeFont:
+	font: ImageFont.FreeTypeFont | None = _fonts.get(size, None)
+	if font is None:
+		font = ImageFont.truetype(FONT_PATH, size)
+		_fonts[size] = font
+	return font
+
+
+def preload_fonts() -> None:
+	for size in (DAY_FONT_SIZE, TITLE_FONT_SIZE, DEFAULT_FONT_SIZE):
+		_get_font(size)
+
+
+def preload_sprites() -> None:
+	for schema in COLOR_SCHEMA.values():
+		for day_num in range(7):
+			_get_sprite(day_num_to_str(day_num), DAY_FONT_SIZE, schema["primary"], schema["bg"])
+		for lesson_type, color in LESSON_TYPE_COLORS.items():
+			_get_sprite(lesson_type, DEFAULT_FONT_SIZE, color, schema["bg"])
+
+
+@functools.lru_cache(maxsize=SPRITE_CACHE_SIZE)
+def _get_sprite(text: str, font_size: int, color: str, bg_color: str) -> tuple[ImageType, int, int]:
+	"""
+	Pre-rendered single line of text on the background it'll be pasted onto
+	@return: (sprite, x offset, y offset), offsets are relative to the baseline text is anchored at
+	"""
+	font: ImageFont.FreeTypeFont = _get_font(font_size)
+	left, top, right, bottom = font.getbbox(text, anchor="ls")
+	sprite: ImageType = Image.new("RGB", (max(1, right - left), max(1, bottom - top)), bg_color)
+	ImageDraw.Draw(sprite).text((-left, -top), text, fill=color, anchor="ls", font=font)
+	return sprite, left, top
+
+
+def _get_placeholder(dark_theme: bool) -> ImageType:
+	placeholder: ImageType | None = _placeholders.get(dark_theme, None)
+	if placeholder is None:
+		with Image.open(PLACEHOLDER_IMG_DARK if dark_theme else PLACEHOLDER_IMG_LIGHT) as file:
+			placeholder = file.convert("RGB")
+		_placeholders[dark_theme] = placeholder
+	return placeholder
+
+
+def _concat_images(images: list[ImageType], dark_theme: bool) -> ImageType:
 	# region Size
 	max_width = 0
 	total_height = 0
@@ -71,124 +174,221 @@ def _concat_images(images_paths: list[str], dark_theme: bool) -> ImageType:
 	return target
 
 
-def _draw_at(drawer: ImageDraw, text: str, font: ImageFont, horizontal_offset: int, vertical_offset: int, color) -> tuple[int, int]:
-	"""
-	@return: Additional offset based on text size
-	"""
-	_lines: list[str] = textwrap.wrap(text, width=MAX_WIDTH_COLUMNS)
-	formatted_text: str = '\n'.join(_lines)
-	# (left, top, right, bottom) bounding box
-	text_bbox: tuple[int, int, int, int] = font.getbbox(formatted_text)
-
-	drawer.multiline_text(
-		(horizontal_offset, vertical_offset),
-		formatted_text, fill=color, anchor="ls", font=font
+@functools.lru_cache(maxsize=LAYOUT_CACHE_SIZE)
+def _layout_text(text: str, font_size: int, max_width: int) -> _TextLayout:
+	"""Wraps text by its measured width in pixels (so wide and narrow letters are treated fairly)"""
+	font: ImageFont.FreeTypeFont = _get_font(font_size)
+	lines: list[str] = []
+	current_line: str = ""
+	for word in text.split():
+		candidate: str = word if not current_line else current_line + ' ' + word
+		if font.getlength(candidate) <= max_width:
+			current_line = candidate
+			continue
+
+		if current_line:
+			lines.append(current_line)
+		# Word that doesn't fit even by itself has to be broken
+		current_line = ""
+		for char in word:
+			if current_line and font.getlength(current_line + char) > max_width:
+				lines.append(current_line)
+				current_line = ""
+			current_line += char
+	if current_line:
+		lines.append(current_line)
+
+	# (left, top, right, bottom) bounding boxes relative to the baseline
+	bboxes: list[tuple[float, float, float, float]] = [font.getbbox(line, anchor="ls") for line in lines]
+	return _TextLayout(
+		tuple(lines),
+		round(max((right - left for left, _, right, _ in bboxes), default=0)),
+		round(max((bottom - top for _, top, _, bottom in bboxes), default=0)),
+		round(max((bottom for *_, bottom in bboxes), default=0)),
 	)
-	# Account for text wrapping
-	new_vertical = len(_lines) * abs(text_bbox[1] - text_bbox[3])
-	return abs(text_bbox[0] - text_bbox[2]), new_vertical
 
 
-def _gen_day(day: list[Lesson], day_num: int, file_path: str, dark_theme: bool) -> None:
-	"""Generates img for specified day at specified path"""
+def _measure_day(day: list[Lesson], day_num: int, dark_theme: bool) -> tuple[list[_TextBlock], int]:
+	"""
+	First (measure) pass: places every piece of text without drawing anything
+	@return: (text blocks to draw, exact height of the image)
+	"""
 	schema: dict[str, str] = COLOR_SCHEMA["dark"] if dark_theme else COLOR_SCHEMA["light"]
-	day_font = ImageFont.truetype(FONT_PATH, 24)
-	title_font = ImageFont.truetype(FONT_PATH, 18)
-	default_font = ImageFont.truetype(FONT_PATH, 14)
-
-	height: int = round((BASE_HEIGHT + OFFSET_BETWEEN_LESSONS + OFFSET_BETWEEN_ROWS * EXPECTED_ROWS_PER_LESSON) * 1.5 * len(day))
-	im = Image.new(
-		"RGB",
-		# Width can be a constant value thanks to text wrapping
-		(16 * MAX_WIDTH_COLUMNS, height),
-		schema["bg"]
-	)
-	dr = ImageDraw.Draw(im)
+	blocks: list[_TextBlock] = []
+
+	def place(text: str, font_size: int, x: int, y: int, color: str, static: bool = False) -> _TextLayout:
+		layout: _TextLayout = _layout_text(text, font_size, IMG_WIDTH - x - BASE_WIDTH)
+		blocks.append(_TextBlock(layout, font_size, x, y, color, static))
+		return layout
 
 	v_offset: int = BASE_HEIGHT
 	h_offset: int = BASE_WIDTH
 	# Day name (row -1)
-	v_offset += _draw_at(dr, day_num_to_str(day_num), day_font, h_offset, v_offset,
-						schema["primary"])[1]
-	
-	for i, lesson in enumerate(day, start=1):
-		lesson: Lesson
+	v_offset += place(
+		day_num_to_str(day_num), DAY_FONT_SIZE, h_offset, v_offset, schema["primary"], static=True
+	).height
 
+	for lesson in day:
 		# Title (row 0)
-		v_offset += _draw_at(dr, lesson.name, title_font, h_offset, v_offset,
-							 schema["text"])[1]
-		# Lesson type (row 1)
-		_row_1_offset = _draw_at(dr, lesson.class_type, default_font, h_offset,
-								 v_offset, LESSON_TYPE_COLORS[lesson.class_type])
-		h_offset += _row_1_offset[0]
-		# Sync or async (row 1)
-		v_offset += _draw_at(dr, lesson.sync_status, default_font, h_offset + BASE_WIDTH * 2,
-							v_offset, schema["text"])[1] + OFFSET_BETWEEN_ROWS
-		h_offset -= _row_1_offset[0]
-		# Duration (row 2)
-		v_offset += _draw_at(dr, lesson.duration_time, default_font, h_offset,
-							 v_offset, schema["text"])[1] + OFFSET_BETWEEN_ROWS
-		# Location (row 3)
-		v_offset += _draw_at(dr, lesson.full_location, default_font, h_offset,
-							 v_offset, schema["text"])[1] + OFFSET_BETWEEN_ROWS
-		# Teacher (row 4)
-		v_offset += _draw_at(dr, lesson.teacher, default_font, h_offset,
-							 v_offset, schema["text"])[1] + OFFSET_BETWEEN_ROWS
+		v_offset += place(lesson.name, TITLE_FONT_SIZE, h_offset, v_offset, schema["text"]).height
+		# Lesson type + sync or async (row 1)
+		lesson_type: _TextLayout = place(
+			lesson.class_type, DEFAULT_FONT_SIZE, h_offset, v_offset, LESSON_TYPE_COLORS[lesson.class_type], static=True
+		)
+		sync_status: _TextLayout = place(
+			lesson.sync_status, DEFAULT_FONT_SIZE, h_offset + lesson_type.width + BASE_WIDTH * 2, v_offset,
+			schema["text"], static=True
+		)
+		v_offset += max(lesson_type.height, sync_status.height) + OFFSET_BETWEEN_ROWS
+		# Duration (row 2), location (row 3), teacher (row 4)
+		for text in (lesson.duration_time, lesson.full_location, lesson.teacher):
+			v_offset += place(text, DEFAULT_FONT_SIZE, h_offset, v_offset, schema["text"]).height + OFFSET_BETWEEN_ROWS
 
 		v_offset += OFFSET_BETWEEN_LESSONS
 
-	im.save(file_path)
+	# Canvas ends right after the lowest piece of text, not after the last offset
+	return blocks, max(block.bottom for block in blocks) + BOTTOM_PADDING
 
 
-def generate_day(day: Day, dark_theme: bool = True) -> str:
-	"""Returns path to the generated image for given day"""
-	# Нет пар или воскресенье
-	if day.day_num == 6 or len(day.lessons) == 0:
-		return PLACEHOLDER_IMG_DARK if dark_theme else PLACEHOLDER_IMG_LIGHT
-	
-	light_theme_img: str = _filename_for_day(day.for_group, day.for_subgroup, day.week_num, day.day_num, False)
-	dark_theme_img: str = _filename_for_day(day.for_group, day.for_subgroup, day.week_num, day.day_num, True)
-	# Generate both dark and light theme variants
-	_gen_day(day.lessons, day.day_num, light_theme_img, False)
-	_gen_day(day.lessons, day.day_num, dark_theme_img, True)
-	# However can't return path to both variants!
-	return dark_theme_img if dark_theme else light_theme_img
-
-
-def generate_week(days: list[Day], dark_theme: bool = True) -> str:
-	images: list[str] = [generate_day(day, dark_theme) for day in days]
-
-	path: str = _filename_for_week(days[0].for_group, days[0].for_subgroup, days[0].week_num, dark_theme)
-	week_image: ImageType = _concat_images(images, dark_theme)
-	week_image.save(path)
-	return path
-# endregion
+def _draw_day(day: list[Lesson], day_num: int, dark_theme: bool) -> ImageType:
+	blocks, height = _measure_day(day, day_num, dark_theme)
+	bg_color: str = (COLOR_SCHEMA["dark"] if dark_theme else COLOR_SCHEMA["light"])["bg"]
+	# Second (draw) pass, canvas is exactly as big as its content
+	im = Image.new("RGB", (IMG_WIDTH, height), bg_color)
+	dr = ImageDraw.Draw(im)
+	for block in blocks:
+		if block.static and len(block.layout.lines) == 1:
+			sprite, x_offset, y_offset = _get_sprite(block.layout.lines[0], block.font_size, block.color, bg_color)
+			im.paste(sprite, (block.x + x_offset, block.y + y_offset))
+			continue
 
+		font: ImageFont.FreeTypeFont = _get_font(block.font_size)
+		for i, line in enumerate(block.layout.lines):
+			dr.text((block.x, block.y + i * block.layout.line_height), line, fill=block.color, anchor="ls", font=font)
+	return im
 
-# region   -- API
-def get_day_image(group: str, subgroup: str, week_num: int, day_index: int, dark_theme: bool = True) -> str:
-	path: str = _filename_for_day(group, subgroup, week_num, day_index, dark_theme)
-	if os.path.isfile(path):
-		return path
 
-	return PLACEHOLDER_IMG_DARK if dark_theme else PLACEHOLDER_IMG_LIGHT
+def day_image(day: Day, dark_theme: bool = True) -> ImageType:
+	if day.is_day_off():
+		return _get_placeholder(dark_theme)
+	return _draw_day(day.lessons, day.day_num, dark_theme)
 
 
-def get_week_images(group: str, subgroup: str, week_num: int, dark_theme: bool = True) -> list[str]:
-	return [get_day_image(group, subgroup, week_num, i, dark_theme) for i in range(6)]
+def week_image(days: list[Day], dark_theme: bool = True) -> ImageType:
+	# Days are composed straight from memory, nothing is encoded/decoded in between
+	return _concat_images([day_image(day, dark_theme) for day in days], dark_theme)
+
+
+def encode(image: ImageType, image_format: str = IMAGE_FORMAT, bytes_budget: int = IMAGE_BYTES_BUDGET) -> EncodedImage:
+	"""
+	Tries encodings for the format from the best looking to the smallest one until the image fits into the budget
+	@param image_format: See TIMETABLE_IMAGE_FORMAT
+	"""
+	started_at: float = time.perf_counter()
+	for encoding, encoder in _encoders(image_format):
+		data: bytes = encoder(image)
+		if len(data) <= bytes_budget:
+			break
+	else:
+		logging.warning(f"Image doesn't fit into {bytes_budget} bytes even as {encoding} ({len(data)} bytes)")
+	return EncodedImage(data, encoding, time.perf_counter() - started_at)
+
+
+def _encoders(image_format: str) -> list[tuple[str, Callable[[ImageType], bytes]]]:
+	if image_format == "png-rgb":
+		return [("png-rgb", functools.partial(_save, format="PNG"))]
+
+	palettes: list[tuple[str, Callable[[ImageType], bytes]]] = [
+		(f"{image_format}-palette{colors}", functools.partial(_save_quantized, colors=colors, format=image_format.upper()))
+		for colors in PALETTE_COLORS
+	]
+	if image_format == "png":
+		return palettes
+	if image_format == "webp":
+		return [("webp-lossless", functools.partial(_save, format="WEBP", lossless=True))] + palettes
+	raise ValueError(f"Unknown image format: `{image_format}` (expected `png`, `png-rgb` or `webp`)")
+
+
+def _save(image: ImageType, **params) -> bytes:
+	buffer = io.BytesIO()
+	image.save(buffer, **params)
+	return buffer.getvalue()
+
+
+def _save_quantized(image: ImageType, colors: int, format: str) -> bytes:
+	# No dithering, it only adds noise to the flat background (and bytes to the output)
+	quantized: ImageType = image.quantize(colors, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+	if format == "WEBP":
+		return _save(quantized, format=format, lossless=True)
+	return _save(quantized, format=format, optimize=True)
+
+
+def render_day(day: Day, dark_theme: bool = True) -> EncodedImage:
+	"""@return: Encoded image (see day_path for where it belongs)"""
+	return encode(day_image(day, dark_theme))
+
+
+def render_week(days: list[Day], dark_theme: bool = True) -> EncodedImage:
+	"""@return: Encoded image (see week_path for where it belongs)"""
+	return encode(week_image(days, dark_theme))
 # endregion
 
 
-def _filename_for_day(group: str, subgroup: str, week_num: int, day_index: int, dark_theme: bool) -> str:
+def day_path(day: Day, dark_theme: bool = True) -> str:
+	"""
+	Note: Images are content-addressed, so identical days
+	(e.g. same day for both subgroups) are rendered only once and shared.
+	Render settings are part of the address too (see _render_settings_digest), so a visual change means new paths.
+	"""
+	if day.is_day_off():
+		return PLACEHOLDER_IMG_DARK if dark_theme else PLACEHOLDER_IMG_LIGHT
+	return _filename_for_day(_render_hash(day.content_hash()), dark_theme)
+
+
+def week_path(days: list[Day], dark_theme: bool = True) -> str:
+	return _filename_for_week(_render_hash("|".join(day.content_hash() for day in days)), dark_theme)
+
+
+def _render_hash(content: str) -> str:
+	"""@param content: Content hash(es) of whatever is rendered (see Day.content_hash)"""
+	return hashlib.sha256(f"{_render_settings_digest()}|{content}".encode()).hexdigest()
+
+
+@functools.cache
+def _render_settings_digest() -> str:
+	"""Everything (besides the timetable itself) that affects how images look and how they're encoded"""
+	settings = hashlib.sha256(repr((
+		RENDER_VERSION, COLOR_SCHEMA, LESSON_TYPE_COLORS,
+		DAY_FONT_SIZE, TITLE_FONT_SIZE, DEFAULT_FONT_SIZE, BASE_HEIGHT, BASE_WIDTH, IMG_WIDTH,
+		OFFSET_BETWEEN_LESSONS, OFFSET_BETWEEN_ROWS, BOTTOM_PADDING,
+		IMAGE_FORMAT, IMAGE_BYTES_BUDGET, PALETTE_COLORS,
+	)).encode())
+	try:
+		with open(FONT_PATH, mode="rb") as font:
+			settings.update(font.read())
+	except OSError:
+		# Nothing can be rendered without it anyway
+		pass
+	return settings.hexdigest()
+
+
+def _filename_for_day(render_hash: str, dark_theme: bool) -> str:
+	"""@param render_hash: See _render_hash"""
 	return os.path.join(
-		IMG_OUTPUT_DIR, f"DAY_{group}_{subgroup}_{day_index}_{week_num}_"
-	) + ("dark" if dark_theme else "light") + ".png"
+		_shard_dir(render_hash), f"DAY_{render_hash}_"
+	) + ("dark" if dark_theme else "light") + "." + IMAGE_EXTENSION
 
 
-def _filename_for_week(group: str, subgroup: str, week_num: int, dark_theme: bool) -> str:
+def _filename_for_week(render_hash: str, dark_theme: bool) -> str:
+	"""@param render_hash: See _render_hash (of all days combined)"""
 	return os.path.join(
-		IMG_OUTPUT_DIR, f"WEEK_{group}_{subgroup}_{week_num}_"
-	) + ("dark" if dark_theme else "light") + ".png"
+		_shard_dir(render_hash), f"WEEK_{render_hash}_"
+	) + ("dark" if dark_theme else "light") + "." + IMAGE_EXTENSION
+
+
+def _shard_dir(render_hash: str) -> str:
+	# Thousands of files in one directory make every lookup/listing slow, so they're spread over 256 subdirectories
+	return os.path.join(IMG_OUTPUT_DIR, render_hash[:2])
 
 
 def init() -> None:
@@ -199,7 +399,5 @@ def init() -> None:
 	os.makedirs(IMG_OUTPUT_DIR, exist_ok=True)
 
 
-def delete_all() -> None:
-	"""Deletes all generated images"""
-	for file in os.listdir(IMG_OUTPUT_DIR):
-		os.remove(os.path.join(IMG_OUTPUT_DIR, file))
+def is_placeholder(path: str) -> bool:
+	return path in (PLACEHOLDER_IMG_LIGHT, PLACEHOLDER_IMG_DARK)
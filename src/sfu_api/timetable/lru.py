@@ -0,0 +1,104 @@
+import time
+from collections import OrderedDict
+from typing import Callable, Generic, Hashable, Iterator, TypeVar
+
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+	"""
+	Least recently used cache bounded by number of entries AND total size (in bytes),
+	with per-entry time to live. NOT thread-safe: every cache (see cacher, image_cache) MUST only be used
+	from the bot's event loop (scheduler jobs included, see cacher.cache_scheduler),
+	background threads (e.g. image_cache's disk thread) only ever get plain values, never the cache itself.
+	"""
+
+	def __init__(
+		self, max_entries: int, max_bytes: int, ttl_seconds: float,
+		size_of: Callable[[V], int], on_evict: Callable[[K, V], None] | None = None
+	):
+		"""
+		@param size_of: Size of the value in bytes (called once per put)
+		@param on_evict: Called for every entry that was evicted/expired/popped (but not replaced!)
+		"""
+		self.max_entries: int = max_entries
+		self.max_bytes: int = max_bytes
+		self.ttl_seconds: float = ttl_seconds
+		self._size_of: Callable[[V], int] = size_of
+		self._on_evict: Callable[[K, V], None] | None = on_evict
+		# key -> (value, size in bytes, expires at)
+		self._entries: OrderedDict[K, tuple[V, int, float]] = OrderedDict()
+		self._bytes: int = 0
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	@property
+	def bytes(self) -> int:
+		return self._bytes
+
+	def get(self, key: K) -> V | None:
+		entry: tuple[V, int, float] | None = self._entries.get(key, None)
+		if entry is None:
+			return None
+		if entry[2] <= time.time():
+			self._remove(key, notify=True)
+			return None
+
+		self._entries.move_to_end(key)
+		return entry[0]
+
+	def peek(self, key: K) -> V | None:
+		"""Same as get, but doesn't count as usage (and ignores TTL)"""
+		entry: tuple[V, int, float] | None = self._entries.get(key, None)
+		return None if entry is None else entry[0]
+
+	def put(self, key: K, value: V, created_at: float | None = None) -> None:
+		"""@param created_at: time.time() TTL is counted from (now by default)"""
+		size: int = self._size_of(value)
+		expires_at: float = (time.time() if created_at is None else created_at) + self.ttl_seconds
+		if key in self._entries:
+			self._remove(key, notify=False)
+		self._entries[key] = (value, size, expires_at)
+		self._bytes += size
+		self._evict()
+
+	def pop(self, key: K) -> V | None:
+		if key not in self._entries:
+			return None
+		return self._remove(key, notify=True)
+
+	def keys(self) -> list[K]:
+		return list(self._entries.keys())
+
+	def items(self) -> Iterator[tuple[K, V]]:
+		"""Note: Doesn't count as usage (i.e. order isn't changed)"""
+		snapshot: list[tuple[K, V]] = [(key, entry[0]) for key, entry in self._entries.items()]
+		return iter(snapshot)
+
+	def expire(self) -> int:
+		"""@return: Number of expired entries that were removed"""
+		now: float = time.time()
+		expired: list[K] = [key for key, entry in self._entries.items() if entry[2] <= now]
+		for key in expired:
+			self._remove(key, notify=True)
+		return len(expired)
+
+	def clear(self) -> None:
+		"""Note: on_evict isn't called"""
+		self._entries.clear()
+		self._bytes = 0
+
+	def _evict(self) -> None:
+		# Always keep at least the newest entry, even if it doesn't fit by itself
+		while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+			self._remove(next(iter(self._entries)), notify=True)
+
+	def _remove(self, key: K, notify: bool) -> V:
+		value, size, _ = self._entries.pop(key)
+		self._bytes -= size
+		if notify and self._on_evict is not None:
+			self._on_evict(key, value)
+		return value
@@ -1,105 +1,221 @@
+import asyncio
 import datetime
 import logging
-from typing import Optional
+import time
+from typing import Awaitable, Callable, Hashable, Optional, TypeVar
 
-import aiohttp
 from urllib import parse
 
-from . import cacher, img_generator
+import metrics
+from . import cacher, render_pool
 from .common import *
-from config import SFU_UNI_TIMEZONE
+from sfu_api import client
+from config import SFU_API_BASE_URL, SFU_UNI_TIMEZONE
 
 
-BASE_URL = "https://edu.sfu-kras.ru/api/timetable/get"
+BASE_URL = SFU_API_BASE_URL
 # NOTE: Apparently Sfu api HAS 2 DIFFERENT URL VARIANTS FOR THE SAME ENDPOINT?!?! (screw you "edu.sfu-kras.ru/api")
 # O_o. If something goes wrong, there is a chance that it's another url variant -_-
 URL_VARIANTS: list[str] = [
 	BASE_URL + "?target={group_name} ({subgroup_name} подгруппа)",
 	BASE_URL + "?target={group_name} (подгруппа {subgroup_name})",
 ]
-aiohttp_session = aiohttp.ClientSession()
+# NOTE: When a lecture ends the whole group spams "Что сегодня?" at the same time.
+# Instead of firing N identical requests (and rendering N identical images), the first caller
+# starts the work and everyone else awaits the same future (see _single_flight)
+_in_flight: dict[Hashable, asyncio.Future] = {}
+# group_name -> index of the url variant (see URL_VARIANTS) that worked for that group last time
+_known_url_variants: dict[str, int] = {}
+_T = TypeVar("_T")
 
 
-async def parse_at(group_name: str, subgroup_name: str, date: Optional[datetime]) -> str | None:
+async def parse_at(
+	group_name: str, subgroup_name: str, date: Optional[datetime], wait_for_fresh: bool = False,
+	theme: str = DEFAULT_THEME
+) -> str | None:
 	"""
+	@param theme: See img_generator.COLOR_SCHEMA
+	@param wait_for_fresh: If True stale image isn't returned right away, but only if refresh fails
 	@return: Path to image file with timetable for today; None - if something went wrong
 	"""
-	lessons: list[Lesson] = []
-
 	# Even/Odd week + day num
-	today_day_num: int = date.weekday() + 1
-	target_week_num: str = str(_get_week_num(date))
-
-	result: Day = Day(today_day_num - 1, int(target_week_num), group_name, subgroup_name, [])
-
-	cache_data: str | None = cacher.try_get_day(group_name, subgroup_name, int(target_week_num), today_day_num)
-	if cache_data is not None:
-		return cache_data
+	target_week_num: int = _get_week_num(date)
+	target_day_num: int = date.weekday()
 
-	json: dict | None = await _get_timetable_json_for(group_name, subgroup_name)
-	if json is None:
-		return None
+	def _render(allow_stale: bool) -> Callable[[], Awaitable[str | None]]:
+		return lambda: _render_day(group_name, subgroup_name, target_week_num, target_day_num, theme, allow_stale)
 
-	for item in json.get("timetable", []):
-		item: dict
-		day_num = int(item.get("day"))
-
-		if day_num == today_day_num and item.get("week", "1") == target_week_num:
-			lessons.append(Lesson.from_json(item))
-		elif day_num > today_day_num:
-			break
-	
-	result.lessons = lessons
-	return cacher.put_day(result)
+	key = ("day", group_name, subgroup_name, target_week_num, target_day_num, theme)
+	cache_data: cacher.CachedImage | None = cacher.try_get_day(
+		group_name, subgroup_name, target_week_num, target_day_num, theme
+	)
+	if cache_data is None:
+		return await _single_flight(key, _render(allow_stale=True))
+	return await _serve_stale_while_revalidate(cache_data, key, _render(allow_stale=False), wait_for_fresh)
 
 
 async def parse_week(
-	group_name: str, subgroup_name: str, force_target_week_num: WeekNum = WeekNum.CURRENT
+	group_name: str, subgroup_name: str, force_target_week_num: WeekNum = WeekNum.CURRENT,
+	wait_for_fresh: bool = False, theme: str = DEFAULT_THEME
 ) -> str | None:
 	"""
 	Parses timetable for current/specified week.
 	@param force_target_week_num: Optional week number (See enum in common.py)
+	@param theme: See img_generator.COLOR_SCHEMA
+	@param wait_for_fresh: If True stale image isn't returned right away, but only if refresh fails
 	@return: Path to generated image; None - if something went wrong
 	"""
-	result: list[Day] = []
-
 	# Even/Odd week
-	target_week_num: str
+	target_week_num: int
 	if force_target_week_num == WeekNum.CURRENT:
-		target_week_num = str(_get_week_num(datetime.now(SFU_UNI_TIMEZONE)))
+		target_week_num = _get_week_num(datetime.now(SFU_UNI_TIMEZONE))
 	else:
-		target_week_num = str(int(force_target_week_num))
+		target_week_num = int(force_target_week_num)
+
+	def _render(allow_stale: bool) -> Callable[[], Awaitable[str | None]]:
+		return lambda: _render_week(group_name, subgroup_name, target_week_num, theme, allow_stale)
+
+	key = ("week", group_name, subgroup_name, target_week_num, theme)
+	cache_data: cacher.CachedImage | None = cacher.try_get_week(group_name, subgroup_name, target_week_num, theme)
+	if cache_data is None:
+		return await _single_flight(key, _render(allow_stale=True))
+	return await _serve_stale_while_revalidate(cache_data, key, _render(allow_stale=False), wait_for_fresh)
 
-	cache_data: str | None = cacher.try_get_week(group_name, subgroup_name, int(target_week_num))
-	if cache_data is not None:
+
+async def get_timetable(group_name: str, subgroup_name: str, allow_stale: bool = True) -> Timetable | None:
+	"""
+	@param allow_stale: If True and SFU api is unavailable last-known-good timetable is returned
+	@return: Parsed timetable (both weeks, all days) for given group; None - if something went wrong
+	"""
+	cache_data: Timetable | None = cacher.try_get_timetable(group_name, subgroup_name)
+	if cache_data is not None and cacher.is_fresh(cache_data.fetched_at):
+		return cache_data
+
+	timetable: Timetable | None = await _single_flight(
+		("timetable", group_name, subgroup_name), lambda: _fetch_timetable(group_name, subgroup_name)
+	)
+	if timetable is None and allow_stale and cache_data is not None:
+		logging.warning(f"Using last-known-good timetable for `{group_name}` ({subgroup_name})")
 		return cache_data
+	return timetable
+
 
+async def get_day_at(group_name: str, subgroup_name: str, date: datetime) -> Day | None:
+	"""
+	Same as parse_at, but without rendering (see text_generator.py)
+	@return: Parsed day; None - if something went wrong
+	"""
+	timetable: Timetable | None = await get_timetable(group_name, subgroup_name)
+	if timetable is None:
+		return None
+	return timetable.day(_get_week_num(date), date.weekday())
+
+
+async def get_week(
+	group_name: str, subgroup_name: str, force_target_week_num: WeekNum = WeekNum.CURRENT
+) -> list[Day] | None:
+	"""
+	Same as parse_week, but without rendering (see text_generator.py)
+	@return: Parsed days of the week; None - if something went wrong
+	"""
+	timetable: Timetable | None = await get_timetable(group_name, subgroup_name)
+	if timetable is None:
+		return None
+	if force_target_week_num == WeekNum.CURRENT:
+		return timetable.week(_get_week_num(datetime.now(SFU_UNI_TIMEZONE)))
+	return timetable.week(int(force_target_week_num))
+
+
+async def build_next_generation(
+	group_name: str, subgroup_name: str
+) -> tuple[Timetable, dict, dict[cacher.CacheKey, cacher.CachedImage]] | None:
+	"""
+	Fetches fresh timetable and re-renders (only changed) images of everything that is cached for that group,
+	WITHOUT touching the live cache (see cacher.swap_generation).
+	@return: (timetable, raw_json, images); None - if something went wrong
+	"""
 	json: dict | None = await _get_timetable_json_for(group_name, subgroup_name)
 	if json is None:
 		return None
 
-	cur_day_num: int = 0
-	current_day: Day = Day(cur_day_num, int(target_week_num), group_name, subgroup_name, [])
-	for item in json.get("timetable", []):
-		item: dict
-		day_num = int(item.get("day"))
-		
-		if day_num == cur_day_num + 1:
-			if item.get("week", "1") == target_week_num:
-				current_day.lessons.append(Lesson.from_json(item))
-		# Finished parsing one day...
-		else:
-			cur_day_num += 1
-			result.append(current_day)
-			# Parse new one
-			current_day = Day(
-				cur_day_num, int(target_week_num), group_name, subgroup_name, []
-			)
-			if item.get("week", "1") == target_week_num:
-				current_day.lessons.append(Lesson.from_json(item))
-	# Final day
-	result.append(current_day)
-	return cacher.put_week(result)
+	timetable: Timetable = Timetable.from_json(group_name, subgroup_name, json)
+	previous: Timetable | None = cacher.try_get_timetable(group_name, subgroup_name, count=False)
+	changed_days: set[tuple[int, int]] = set()
+	if previous is not None:
+		changed_days = timetable.changed_days(previous)
+
+	images: dict[cacher.CacheKey, cacher.CachedImage] = {}
+	for key, image in cacher.cached_images_for(group_name, subgroup_name):
+		path: str = image.path
+		if cacher.is_changed(key, changed_days):
+			path = await _render_image(timetable, key)
+		images[key] = cacher.CachedImage(path, timetable.fetched_at)
+
+	return timetable, json, images
+
+
+async def _render_image(timetable: Timetable, key: cacher.CacheKey) -> str:
+	dark_theme: bool = key.theme == "dark"
+	if key.day_num is None:
+		return await render_pool.render_week(timetable.week(key.week_num), dark_theme)
+	return await render_pool.render_day(timetable.day(key.week_num, key.day_num), dark_theme)
+
+
+async def _fetch_timetable(group_name: str, subgroup_name: str) -> Timetable | None:
+	json: dict | None = await _get_timetable_json_for(group_name, subgroup_name)
+	if json is None:
+		return None
+	# One upstream call answers every later day/week query for that group
+	return cacher.put_timetable(Timetable.from_json(group_name, subgroup_name, json), json)
+
+
+async def _render_day(
+	group_name: str, subgroup_name: str, week_num: int, day_num: int, theme: str, allow_stale: bool
+) -> str | None:
+	timetable: Timetable | None = await get_timetable(group_name, subgroup_name, allow_stale)
+	if timetable is None:
+		return None
+	# Fresh timetable might be exactly the same as before, then there is nothing to re-render
+	cache_data: cacher.CachedImage | None = cacher.try_get_day(
+		group_name, subgroup_name, week_num, day_num, theme, count=False
+	)
+	if cache_data is not None and cacher.is_fresh(cache_data.fetched_at):
+		return cache_data.path
+	return await cacher.put_day(timetable.day(week_num, day_num), timetable.fetched_at, theme)
+
+
+async def _render_week(
+	group_name: str, subgroup_name: str, week_num: int, theme: str, allow_stale: bool
+) -> str | None:
+	timetable: Timetable | None = await get_timetable(group_name, subgroup_name, allow_stale)
+	if timetable is None:
+		return None
+	cache_data: cacher.CachedImage | None = cacher.try_get_week(
+		group_name, subgroup_name, week_num, theme, count=False
+	)
+	if cache_data is not None and cacher.is_fresh(cache_data.fetched_at):
+		return cache_data.path
+	return await cacher.put_week(timetable.week(week_num), timetable.fetched_at, theme)
+
+
+async def _serve_stale_while_revalidate(
+	cache_data: cacher.CachedImage, key: tuple, render: Callable[[], Awaitable[str | None]], wait_for_fresh: bool
+) -> str:
+	"""
+	Fresh data is returned as is. Stale data is returned right away (zero-wait for users),
+	while the fresh one is being rendered in the background.
+	"""
+	if cacher.is_fresh(cache_data.fetched_at):
+		return cache_data.path
+
+	refresh: asyncio.Future = _start_once(("refresh", *key), render)
+	if not wait_for_fresh:
+		return cache_data.path
+
+	result: str | None = await asyncio.shield(refresh)
+	if result is None:
+		return cache_data.path
+	return result
 
 
 def _get_week_num(now_datetime: datetime) -> int:
@@ -108,27 +224,90 @@ def _get_week_num(now_datetime: datetime) -> int:
 	return int(WeekNum.EVEN)
 
 
+async def _single_flight(key: Hashable, func: Callable[[], Awaitable[_T]]) -> _T:
+	"""
+	Runs func() only once for all concurrent callers with the same key.
+	(Later callers simply await the result of the call that is already in progress)
+	"""
+	# Shield, so one impatient (cancelled) caller doesn't cancel the work for everyone else
+	return await asyncio.shield(_start_once(key, func))
+
+
+def _start_once(key: Hashable, func: Callable[[], Awaitable[_T]]) -> asyncio.Future:
+	"""@return: Future of func() that is already in progress for that key (or a new one)"""
+	future: asyncio.Future | None = _in_flight.get(key, None)
+	if future is None:
+		future = asyncio.ensure_future(func())
+		_in_flight[key] = future
+
+		def _forget(done: asyncio.Future) -> None:
+			if _in_flight.get(key, None) is done:
+				del _in_flight[key]
+			# Background refreshes might not have anyone waiting for them
+			if not done.cancelled() and done.exception() is not None:
+				logging.error(f"Unhandled error while processing `{key}`", exc_info=done.exception())
+		future.add_done_callback(_forget)
+	return future
+
+
 async def _get_timetable_json_for(group_name: str, subgroup_name: str) -> dict | None:
-	for variant in URL_VARIANTS:
-		url: str = variant.format(
-			group_name=group_name, subgroup_name=subgroup_name
-		)
-		encoded = parse.urlencode(parse.parse_qs(parse.urlparse(url).query), doseq=True)
-		url = "{}&{}".format(BASE_URL, encoded)
-		try:
-			async with aiohttp_session.get(url) as response:
-				if response.status == 200:
-					json: dict = await response.json()
-					# If empty try next url variant...
-					if len(json.get("timetable", [])) == 0:
-						continue
+	started_at: float = time.perf_counter()
+	json: dict | None = await _get_timetable_json_for_any_variant(group_name, subgroup_name)
+	metrics.sfu_fetches.observe(time.perf_counter() - started_at, result="failed" if json is None else "ok")
+	return json
+
+
+async def _get_timetable_json_for_any_variant(group_name: str, subgroup_name: str) -> dict | None:
+	known_variant: int | None = _known_url_variants.get(group_name, None)
+	if known_variant is not None:
+		json: dict | None = await _get_timetable_json_with(known_variant, group_name, subgroup_name)
+		# SFU api is having a bad day, hammering it with the other variants won't help
+		if json is None:
+			return None
+		if not _is_empty(json):
+			return json
+		# Group switched url variant (yeah...), so try all of them again
+		del _known_url_variants[group_name]
+
+	return await _race_url_variants(group_name, subgroup_name)
+
+
+async def _race_url_variants(group_name: str, subgroup_name: str) -> dict | None:
+	"""
+	Calls all url variants at once and returns the first non-empty timetable
+	(instead of paying for a wasted round trip for groups with the "wrong" url variant)
+	"""
+	pending: dict[asyncio.Task, int] = {
+		asyncio.ensure_future(_get_timetable_json_with(i, group_name, subgroup_name)): i
+		for i in range(len(URL_VARIANTS))
+	}
+	try:
+		while len(pending) != 0:
+			done, _ = await asyncio.wait(pending.keys(), return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				variant: int = pending.pop(task)
+				json: dict | None = task.result()
+				if json is not None and not _is_empty(json):
+					_known_url_variants[group_name] = variant
 					return json
-				logging.error(f"Error {response.status} while calling SFU API `{url}`")
-		except aiohttp.ClientError as e:
-			logging.error(f"Failed to call SFU API `{url}`", exec_info=e)
-	
+	finally:
+		# Nobody cares about the slower variant anymore
+		for task in pending:
+			task.cancel()
+
 	return None
 
 
-async def close_http_session() -> None:
-	await aiohttp_session.close()
+async def _get_timetable_json_with(variant: int, group_name: str, subgroup_name: str) -> dict | None:
+	"""@return: Json (timetable might be empty, see _is_empty); None - if request failed"""
+	url: str = URL_VARIANTS[variant].format(
+		group_name=group_name, subgroup_name=subgroup_name
+	)
+	encoded = parse.urlencode(parse.parse_qs(parse.urlparse(url).query), doseq=True)
+	url = "{}&{}".format(BASE_URL, encoded)
+	return await client.get_json(url)
+
+
+def _is_empty(json: dict) -> bool:
+	# Empty means wrong url variant (probably)
+	return len(json.get("timetable", [])) == 0
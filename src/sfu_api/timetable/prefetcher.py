@@ -0,0 +1,92 @@
+import asyncio
+import logging
+
+from . import cacher, parser
+from .common import *
+from config import SFU_UNI_TIMEZONE
+
+
+# Warm-up shouldn't eat all the bandwidth/CPU that real users need
+WARM_UP_MAX_CONCURRENCY: int = 4
+WARM_UP_LOG_EVERY_N_GROUPS: int = 25
+
+
+async def warm_up(targets: list[tuple[str, str]], max_concurrency: int = WARM_UP_MAX_CONCURRENCY) -> None:
+	"""
+	Fetches and pre-renders today's image and both week images for every (group, subgroup),
+	so the morning rush is served from cache.
+	@param targets: List of (group, subgroup) pairs
+	"""
+	if len(targets) == 0:
+		return
+
+	semaphore = asyncio.Semaphore(max_concurrency)
+	finished: int = 0
+	failed: int = 0
+	started_at: datetime = datetime.now()
+	logging.info(f"Timetable warm-up started for {len(targets)} groups")
+
+	async def _warm_up_one(group: str, subgroup: str) -> None:
+		nonlocal finished, failed
+
+		async with semaphore:
+			results: list[str | None] = [
+				await parser.parse_at(group, subgroup, datetime.now(SFU_UNI_TIMEZONE), wait_for_fresh=True),
+				await parser.parse_week(group, subgroup, WeekNum.ODD, wait_for_fresh=True),
+				await parser.parse_week(group, subgroup, WeekNum.EVEN, wait_for_fresh=True),
+			]
+		finished += 1
+		if None in results:
+			failed += 1
+			logging.warning(f"Timetable warm-up failed for `{group}` ({subgroup})")
+		if finished % WARM_UP_LOG_EVERY_N_GROUPS == 0:
+			logging.info(f"Timetable warm-up: {finished}/{len(targets)} groups ({failed} failed)")
+
+	# Note: One broken group shouldn't stop the rest
+	results = await asyncio.gather(*(_warm_up_one(*target) for target in targets), return_exceptions=True)
+	for result in results:
+		if isinstance(result, BaseException):
+			logging.error("Unexpected error during timetable warm-up", exc_info=result)
+
+	logging.info(
+		f"Timetable warm-up finished: {finished}/{len(targets)} groups ({failed} failed) "
+		f"in {(datetime.now() - started_at).total_seconds():.1f}s"
+	)
+
+
+async def refresh(targets: list[tuple[str, str]], max_concurrency: int = WARM_UP_MAX_CONCURRENCY) -> None:
+	"""
+	Builds the next cache generation for every (group, subgroup) alongside the live one
+	and swaps it in all at once (so users never see half-refreshed/missing data).
+	Groups that failed to refresh simply keep their current (soon to be stale) entries.
+	@param targets: List of (group, subgroup) pairs
+	"""
+	semaphore = asyncio.Semaphore(max_concurrency)
+	started_at: datetime = datetime.now()
+	logging.info(f"Timetable refresh started for {len(targets)} groups")
+
+	async def _build_one(group: str, subgroup: str):
+		async with semaphore:
+			return await parser.build_next_generation(group, subgroup)
+
+	results = await asyncio.gather(*(_build_one(*target) for target in targets), return_exceptions=True)
+	timetables: list[tuple[Timetable, dict]] = []
+	images: dict = {}
+	failed: int = 0
+	for (group, subgroup), result in zip(targets, results):
+		if isinstance(result, BaseException):
+			logging.error(f"Unexpected error during timetable refresh for `{group}` ({subgroup})", exc_info=result)
+			failed += 1
+		elif result is None:
+			logging.warning(f"Timetable refresh failed for `{group}` ({subgroup})")
+			failed += 1
+		else:
+			timetable, raw_json, new_images = result
+			timetables.append((timetable, raw_json))
+			images.update(new_images)
+
+	cacher.swap_generation(timetables, images)
+	logging.info(
+		f"Timetable refresh finished: {len(targets) - failed}/{len(targets)} groups ({failed} failed) "
+		f"in {(datetime.now() - started_at).total_seconds():.1f}s"
+	)
@@ -0,0 +1,101 @@
+# Pillow drawing + PNG encoding are CPU-bound and would freeze the bot's event loop,
+# so rendering happens in a pool of workers (see img_generator for the rendering itself)
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+from . import image_cache, img_generator
+from .common import Day
+from config import RENDER_EXECUTOR, RENDER_WORKERS
+
+
+_executor: Executor | None = None
+# (kind, workers) of the last init(), so a broken pool is re-created the same way
+_settings: tuple[str, int] = (RENDER_EXECUTOR, RENDER_WORKERS)
+
+
+def _init_worker() -> None:
+	img_generator.preload_fonts()
+	img_generator.preload_sprites()
+
+
+def init(kind: str = RENDER_EXECUTOR, workers: int = RENDER_WORKERS) -> None:
+	"""
+	@param kind: "process" or "thread"
+	@param workers: 0 - one worker per core
+	"""
+	global _executor, _settings
+
+	shutdown()
+	_settings = (kind, workers)
+	workers = workers or os.cpu_count() or 1
+	if kind == "process":
+		# Bot has running threads/event loop by the time workers are started, forking that is asking for trouble
+		_executor = ProcessPoolExecutor(
+			workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_worker
+		)
+	elif kind == "thread":
+		_executor = ThreadPoolExecutor(workers, thread_name_prefix="render", initializer=_init_worker)
+	else:
+		raise ValueError(f"Unknown render executor: `{kind}` (expected `process` or `thread`)")
+	logging.info(f"Render pool: {workers} {kind} workers")
+
+
+def shutdown() -> None:
+	global _executor
+
+	if _executor is not None:
+		_executor.shutdown(wait=False, cancel_futures=True)
+		_executor = None
+
+
+async def render_day(day: Day, dark_theme: bool = True) -> str:
+	"""
+	Renders day image (unless it's already there) without blocking the event loop
+	@return: Path to the image (see image_cache)
+	"""
+	path: str = img_generator.day_path(day, dark_theme)
+	if not image_cache.contains(path):
+		with metrics.renders.time(kind="day"):
+			image: img_generator.EncodedImage = await _run(img_generator.render_day, day, dark_theme)
+		_put(path, image)
+	return path
+
+
+async def render_week(days: list[Day], dark_theme: bool = True) -> str:
+	"""
+	Renders week image (unless it's already there) without blocking the event loop
+	@return: Path to the image (see image_cache)
+	"""
+	path: str = img_generator.week_path(days, dark_theme)
+	if not image_cache.contains(path):
+		with metrics.renders.time(kind="week"):
+			image: img_generator.EncodedImage = await _run(img_generator.render_week, days, dark_theme)
+		_put(path, image)
+	return path
+
+
+def _put(path: str, image: img_generator.EncodedImage) -> None:
+	# Encoding happens inside workers, so its metrics are recorded here
+	metrics.encodes.observe(image.seconds, encoding=image.encoding)
+	metrics.encoded_bytes.observe(len(image.data), encoding=image.encoding)
+	image_cache.put(path, image.data)
+
+
+async def _run(func, *args):
+	if _executor is None:
+		init(*_settings)
+	executor: Executor = _executor
+	try:
+		return await asyncio.get_running_loop().run_in_executor(executor, func, *args)
+	except BrokenProcessPool:
+		# One crashed/OOM-killed worker breaks the whole pool for good, so it's re-created (only once,
+		# every render that was in flight gets the same error) and the render is retried once
+		if _executor is executor:
+			logging.error("Render pool is broken (worker died?), re-creating it")
+			init(*_settings)
+		return await asyncio.get_running_loop().run_in_executor(_executor, func, *args)
@@ -0,0 +1,217 @@
+# Persistent copy of the timetable cache (see cacher.py), so restarts don't start cold
+import json
+import logging
+import sqlite3 as sql
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any
+
+
+STORE_PATH: str = "timetable_cache.db"
+# Special day_num for week images
+WEEK_DAY_NUM: int = -1
+
+# Every query runs here: writes are queued (cache puts/evictions happen on the bot's event loop,
+# a commit == fsync there would freeze every user), reads wait for the writes queued before them.
+# Single thread == queries never run concurrently and happen in the order they were made
+_store_thread = ThreadPoolExecutor(1, thread_name_prefix="timetable-store")
+# Opened by init_store (so STORE_PATH can still be changed before that, e.g. by benchmarks), only used from _store_thread
+_db: sql.Connection | None = None
+
+
+def init_store() -> None:
+	_store_thread.submit(_init_store).result()
+
+
+def _init_store() -> None:
+	global _db
+
+	if _db is None:
+		_db = sql.connect(STORE_PATH)
+	try:
+		# Manifest without themes is from an older version, it's just a cache, so...
+		columns: list[str] = [row[1] for row in _db.execute("PRAGMA table_info(images)").fetchall()]
+		if len(columns) != 0 and "theme" not in columns:
+			_db.execute("DROP TABLE images")
+		_db.executescript(
+			"""
+			CREATE TABLE IF NOT EXISTS timetables
+			(
+				group_name TEXT,
+				subgroup TEXT,
+				raw_json TEXT,
+				fetched_at REAL,
+				PRIMARY KEY (group_name, subgroup)
+			);
+			CREATE TABLE IF NOT EXISTS images
+			(
+				group_name TEXT,
+				subgroup TEXT,
+				week_num INTEGER,
+				day_num INTEGER,
+				theme TEXT,
+				path TEXT,
+				fetched_at REAL,
+				PRIMARY KEY (group_name, subgroup, week_num, day_num, theme)
+			);
+			CREATE TABLE IF NOT EXISTS telegram_files
+			(
+				path TEXT PRIMARY KEY,
+				fingerprint TEXT,
+				file_id TEXT
+			);
+			"""
+		)
+		_db.commit()
+	except sql.Error as err:
+		logging.exception(f"SQL error: {err.sqlite_errorname}", exc_info=err)
+
+
+# region    -- Timetables
+def save_timetable(group: str, subgroup: str, raw_json: dict, fetched_at: float) -> None:
+	"""@param raw_json: Response from SFU api as is"""
+	_execute(
+		"INSERT OR REPLACE INTO timetables VALUES(?, ?, ?, ?)",
+		(group, subgroup, json.dumps(raw_json, ensure_ascii=False), fetched_at),
+	)
+
+
+def load_timetables() -> list[tuple[str, str, dict, float]]:
+	"""@return: List of (group, subgroup, raw_json, fetched_at); broken entries are skipped"""
+	result: list[tuple[str, str, dict, float]] = []
+	for group, subgroup, raw_json, fetched_at in _fetch_all("SELECT * FROM timetables"):
+		try:
+			result.append((group, subgroup, json.loads(raw_json), float(fetched_at)))
+		except (TypeError, ValueError) as err:
+			logging.warning(f"Skipping broken persisted timetable for `{group}` ({subgroup}): {err}")
+	return result
+
+
+def delete_timetable(group: str, subgroup: str) -> None:
+	_execute("DELETE FROM timetables WHERE group_name == ? AND subgroup == ?", (group, subgroup))
+# endregion -- Timetables
+
+
+# region    -- Images
+def save_image(
+	group: str, subgroup: str, week_num: int, day_num: int, theme: str, path: str, fetched_at: float
+) -> None:
+	"""@param day_num: WEEK_DAY_NUM for week images"""
+	_execute(
+		"INSERT OR REPLACE INTO images VALUES(?, ?, ?, ?, ?, ?, ?)",
+		(group, subgroup, week_num, day_num, theme, path, fetched_at),
+	)
+
+
+def load_images() -> list[tuple[str, str, int, int, str, str, float]]:
+	"""@return: List of (group, subgroup, week_num, day_num, theme, path, fetched_at)"""
+	return _fetch_all("SELECT * FROM images")
+
+
+def delete_image(group: str, subgroup: str, week_num: int, day_num: int, theme: str) -> None:
+	_execute(
+		"DELETE FROM images WHERE group_name == ? AND subgroup == ? AND week_num == ? AND day_num == ? AND theme == ?",
+		(group, subgroup, week_num, day_num, theme),
+	)
+# endregion -- Images
+
+
+# region    -- Telegram file ids
+def save_file_id(path: str, fingerprint: str, file_id: str) -> None:
+	"""@param fingerprint: Anything that changes when file at path changes"""
+	_execute("INSERT OR REPLACE INTO telegram_files VALUES(?, ?, ?)", (path, fingerprint, file_id))
+
+
+def load_file_ids() -> list[tuple[str, str, str]]:
+	"""@return: List of (path, fingerprint, file_id)"""
+	return _fetch_all("SELECT * FROM telegram_files")
+
+
+def delete_file_id(path: str) -> None:
+	_execute("DELETE FROM telegram_files WHERE path == ?", (path,))
+
+
+def delete_file_ids(paths: list[str]) -> None:
+	"""Same as delete_file_id, but in one transaction"""
+	_execute_many("DELETE FROM telegram_files WHERE path == ?", [(path,) for path in paths])
+# endregion -- Telegram file ids
+
+
+def save_generation(
+	timetables: list[tuple[str, str, dict, float]], images: list[tuple[str, str, int, int, str, str, float]]
+) -> None:
+	"""
+	Saves the whole cache generation (see cacher.swap_generation) in one transaction, instead of a commit per entry
+	@param timetables: List of (group, subgroup, raw_json, fetched_at) - see save_timetable
+	@param images: List of (group, subgroup, week_num, day_num, theme, path, fetched_at) - see save_image
+	"""
+	_store_thread.submit(_save_generation_now, timetables, images)
+
+
+def clear() -> None:
+	"""Note: Telegram file ids are kept, they don't depend on timetables"""
+	_execute("DELETE FROM timetables")
+	_execute("DELETE FROM images")
+
+
+def flush() -> None:
+	"""Waits until all queued writes are done (e.g. before shutdown)"""
+	_store_thread.submit(lambda: None).result()
+
+
+def _execute(query: str, params: tuple[Any, ...] = ()) -> None:
+	"""Queues the query, nothing waits for it (errors are logged)"""
+	_store_thread.submit(_execute_now, query, params)
+
+
+def _execute_many(query: str, params: list[tuple[Any, ...]]) -> None:
+	"""Same as _execute, but for every params (one commit for all of them)"""
+	_store_thread.submit(_execute_many_now, query, params)
+
+
+def _fetch_all(query: str) -> list[Any]:
+	return _store_thread.submit(_fetch_all_now, query).result()
+
+
+# region    -- Store thread
+def _execute_now(query: str, params: tuple[Any, ...]) -> None:
+	try:
+		_db.execute(query, params)
+		_db.commit()
+	except sql.Error as err:
+		logging.exception(f"SQL error: {err.sqlite_errorname}", exc_info=err)
+
+
+def _execute_many_now(query: str, params: list[tuple[Any, ...]]) -> None:
+	try:
+		_db.executemany(query, params)
+		_db.commit()
+	except sql.Error as err:
+		_db.rollback()
+		logging.exception(f"SQL error: {err.sqlite_errorname}", exc_info=err)
+
+
+def _save_generation_now(
+	timetables: list[tuple[str, str, dict, float]], images: list[tuple[str, str, int, int, str, str, float]]
+) -> None:
+	try:
+		_db.executemany(
+			"INSERT OR REPLACE INTO timetables VALUES(?, ?, ?, ?)",
+			(
+				(group, subgroup, json.dumps(raw_json, ensure_ascii=False), fetched_at)
+				for group, subgroup, raw_json, fetched_at in timetables
+			),
+		)
+		_db.executemany("INSERT OR REPLACE INTO images VALUES(?, ?, ?, ?, ?, ?, ?)", images)
+		_db.commit()
+	except sql.Error as err:
+		_db.rollback()
+		logging.exception(f"SQL error: {err.sqlite_errorname}", exc_info=err)
+
+
+def _fetch_all_now(query: str) -> list[Any]:
+	try:
+		return _db.execute(query).fetchall()
+	except sql.Error as err:
+		logging.exception(f"SQL error: {err.sqlite_errorname}", exc_info=err)
+		return []
+# endregion -- Store thread
@@ -0,0 +1,69 @@
+# Text (Telegram HTML) version of the timetable images (see img_generator.py):
+# nothing to render or upload, so it's much lighter for users on bad connections (and for the bot)
+from html import escape
+
+from .common import *
+
+
+# Telegram's limit for a single text message
+MAX_MESSAGE_LENGTH: int = 4096
+# Longer fields are cut, so any line (even fully escaped) fits into a single message
+MAX_FIELD_LENGTH: int = 256
+DAY_OFF_TEXT: str = "Выходной"
+
+
+def _field(value: str) -> str:
+	if len(value) > MAX_FIELD_LENGTH:
+		value = value[:MAX_FIELD_LENGTH - 1] + "…"
+	return escape(value)
+
+
+def _lesson_text(lesson: Lesson) -> str:
+	# NOTE: Every line closes all of its tags, so messages can be split between any two lines (see _pack)
+	lines: list[str] = [
+		f"<code>{_field(lesson.duration_time)}</code> <b>{_field(lesson.name)}</b>",
+		f"<i>{_field(lesson.class_type)}, {_field(lesson.sync_status)}</i>",
+	]
+	if lesson.teacher:
+		lines.append(_field(lesson.teacher))
+	if lesson.full_location:
+		lines.append(_field(lesson.full_location))
+	return "\n".join(lines)
+
+
+def day_text(day: Day) -> str:
+	"""@return: Day in Telegram HTML (parse_mode="HTML")"""
+	title: str = f"<b>{escape(day_num_to_str(day.day_num))}</b>"
+	# Not day.is_day_off(): Sunday placeholder is an image thing, Sunday with lessons has to show them
+	if len(day.lessons) == 0:
+		return f"{title}\n{DAY_OFF_TEXT}"
+	return title + "\n\n" + "\n\n".join(_lesson_text(lesson) for lesson in day.lessons)
+
+
+def week_texts(days: list[Day]) -> list[str]:
+	"""
+	@return: Week in Telegram HTML (parse_mode="HTML"), split into as few messages as possible
+	(days are never split between messages, unless a single day doesn't fit by itself)
+	"""
+	messages: list[str] = []
+	for day in days:
+		_pack(messages, day_text(day), "\n\n")
+	return messages
+
+
+def _pack(messages: list[str], text: str, separator: str) -> None:
+	"""
+	Appends text to the last message (if it fits) or starts a new one.
+	Text that doesn't fit into a message by itself is split into lessons, then (if still needed) into lines,
+	never in the middle of a line, so no tag/entity is ever cut in half.
+	"""
+	if len(text) > MAX_MESSAGE_LENGTH and "\n" in text:
+		inner_separator: str = "\n\n" if "\n\n" in text else "\n"
+		for i, part in enumerate(text.split(inner_separator)):
+			_pack(messages, part, separator if i == 0 else inner_separator)
+		return
+
+	if len(messages) != 0 and len(messages[-1]) + len(separator) + len(text) <= MAX_MESSAGE_LENGTH:
+		messages[-1] += separator + text
+	else:
+		messages.append(text)
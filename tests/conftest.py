@@ -0,0 +1,7 @@
+# Modules under src read config at import time, so it has to be set up before any of them is imported
+import os
+import sys
+
+os.environ.setdefault("TELEGRAM_TOKEN", "test")
+os.environ.setdefault("TELEGRAM_SUPPORT_TOKEN", "test")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
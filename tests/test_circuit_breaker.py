@@ -0,0 +1,80 @@
+from sfu_api.client import CircuitBreaker
+
+
+def open_breaker(reset_timeout: float) -> CircuitBreaker:
+	breaker = CircuitBreaker(failure_threshold=3, reset_timeout=reset_timeout)
+	for _ in range(3):
+		breaker.record_failure()
+	return breaker
+
+
+def test_stays_closed_below_threshold() -> None:
+	breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+	breaker.record_failure()
+	breaker.record_failure()
+
+	assert not breaker.is_open
+	assert breaker.allow_request()
+
+
+def test_success_resets_failures_in_a_row() -> None:
+	breaker = CircuitBreaker(failure_threshold=3, reset_timeout=60)
+	breaker.record_failure()
+	breaker.record_failure()
+	breaker.record_success()
+	breaker.record_failure()
+
+	assert not breaker.is_open
+
+
+def test_opens_after_threshold_and_fails_fast() -> None:
+	breaker = open_breaker(reset_timeout=60)
+
+	assert breaker.is_open
+	assert not breaker.allow_request()
+
+
+def test_half_open_lets_exactly_one_probe_through() -> None:
+	breaker = open_breaker(reset_timeout=0)
+
+	assert breaker.allow_request()
+	assert not breaker.allow_request()
+	assert breaker.is_open
+
+
+def test_successful_probe_closes() -> None:
+	breaker = open_breaker(reset_timeout=0)
+	assert breaker.allow_request()
+	breaker.record_success()
+
+	assert not breaker.is_open
+	assert breaker.allow_request()
+	assert breaker.allow_request()
+
+
+def test_failed_probe_opens_again() -> None:
+	breaker = open_breaker(reset_timeout=0)
+	assert breaker.allow_request()
+	breaker.record_failure()
+
+	assert breaker.is_open
+	# Reset timeout starts over (it's 0 here, so the next probe is allowed right away)
+	assert breaker.allow_request()
+	assert not breaker.allow_request()
+
+
+def test_failed_probe_waits_for_reset_timeout() -> None:
+	breaker = open_breaker(reset_timeout=0)
+	assert breaker.allow_request()
+	breaker.reset_timeout = 60
+	breaker.record_failure()
+
+	assert not breaker.allow_request()
+
+
+def test_cancelled_probe_allows_another_one() -> None:
+	breaker = open_breaker(reset_timeout=0)
+	assert breaker.allow_request()
+	breaker.record_cancel()
+
+	assert breaker.allow_request()
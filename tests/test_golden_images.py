@@ -0,0 +1,43 @@
+# Renders the same synthetic timetables as benchmarks/bench_render.py and compares them with
+# golden images (benchmarks/golden), so render optimizations can't silently change how timetables look.
+# After an intentional visual change: python benchmarks/bench_render.py --update-golden
+import os
+import sys
+from typing import Iterator
+
+import pytest
+from PIL import Image
+
+PROJECT_ROOT: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ASSETS_DIR: str = os.path.join(PROJECT_ROOT, "_timetable_images", "_assets")
+sys.path.insert(0, os.path.join(PROJECT_ROOT, "benchmarks"))
+
+import bench_render  # noqa: E402
+from sfu_api.timetable import img_generator  # noqa: E402
+
+
+FIXTURES = bench_render.make_fixtures()
+
+
+@pytest.fixture(scope="module", autouse=True)
+def project_assets() -> Iterator[None]:
+	"""img_generator resolves its assets from the working directory, so they're pointed at the project's ones"""
+	with pytest.MonkeyPatch.context() as monkeypatch:
+		monkeypatch.setattr(img_generator, "FONT_PATH", os.path.join(ASSETS_DIR, "Roboto-Medium.ttf"))
+		monkeypatch.setattr(img_generator, "PLACEHOLDER_IMG_LIGHT", os.path.join(ASSETS_DIR, "default_img_light.png"))
+		monkeypatch.setattr(img_generator, "PLACEHOLDER_IMG_DARK", os.path.join(ASSETS_DIR, "default_img_dark.png"))
+		yield
+
+
+@pytest.mark.parametrize("dark_theme", [True, False], ids=["dark", "light"])
+@pytest.mark.parametrize("name", list(FIXTURES))
+def test_render_matches_golden(name: str, dark_theme: bool) -> None:
+	actual = bench_render.render(FIXTURES[name], dark_theme)
+	with Image.open(bench_render.golden_path(name, dark_theme)) as expected:
+		assert actual.size == expected.size
+		different, max_diff = bench_render.compare(actual, expected)
+
+	assert different <= bench_render.GOLDEN_TOLERANCE, (
+		f"{different * 100:.3f}% pixels differ (max channel diff {max_diff}), "
+		f"see `python benchmarks/bench_render.py --check-golden --diff-dir <dir>`"
+	)
@@ -0,0 +1,107 @@
+import time
+
+from sfu_api.timetable.lru import LRUCache
+
+
+def make_cache(
+	max_entries: int = 3, max_bytes: int = 1000, ttl_seconds: float = 60
+) -> tuple[LRUCache[str, str], list[tuple[str, str]]]:
+	"""@return: (cache where size of a value is its length, list of everything on_evict was called with)"""
+	evicted: list[tuple[str, str]] = []
+	cache: LRUCache[str, str] = LRUCache(
+		max_entries, max_bytes, ttl_seconds, len, lambda key, value: evicted.append((key, value))
+	)
+	return cache, evicted
+
+
+def test_evicts_least_recently_used_entry() -> None:
+	cache, evicted = make_cache(max_entries=2)
+	cache.put("a", "1")
+	cache.put("b", "2")
+	# "a" becomes the most recently used one
+	assert cache.get("a") == "1"
+	cache.put("c", "3")
+
+	assert cache.keys() == ["a", "c"]
+	assert evicted == [("b", "2")]
+
+
+def test_peek_doesnt_count_as_usage() -> None:
+	cache, evicted = make_cache(max_entries=2)
+	cache.put("a", "1")
+	cache.put("b", "2")
+	assert cache.peek("a") == "1"
+	cache.put("c", "3")
+
+	assert evicted == [("a", "1")]
+
+
+def test_evicts_until_it_fits_into_bytes_budget() -> None:
+	cache, evicted = make_cache(max_entries=10, max_bytes=10)
+	cache.put("a", "xxxx")
+	cache.put("b", "xxxx")
+	cache.put("c", "xxxx")
+
+	assert cache.keys() == ["b", "c"]
+	assert cache.bytes == 8
+	assert evicted == [("a", "xxxx")]
+
+
+def test_keeps_newest_entry_even_if_it_doesnt_fit() -> None:
+	cache, evicted = make_cache(max_bytes=10)
+	cache.put("a", "x")
+	cache.put("b", "x" * 100)
+
+	assert cache.keys() == ["b"]
+	assert evicted == [("a", "x")]
+
+
+def test_expired_entries_are_not_served() -> None:
+	cache, evicted = make_cache(ttl_seconds=60)
+	cache.put("old", "1", created_at=time.time() - 61)
+	cache.put("new", "2")
+
+	assert cache.get("old") is None
+	assert cache.get("new") == "2"
+	assert evicted == [("old", "1")]
+
+
+def test_expire_removes_only_expired_entries() -> None:
+	cache, evicted = make_cache(ttl_seconds=60)
+	cache.put("old", "1", created_at=time.time() - 61)
+	cache.put("new", "2")
+
+	assert cache.expire() == 1
+	assert cache.keys() == ["new"]
+	assert evicted == [("old", "1")]
+
+
+def test_replaced_entry_isnt_evicted() -> None:
+	cache, evicted = make_cache()
+	cache.put("a", "old")
+	cache.put("a", "new")
+
+	assert cache.get("a") == "new"
+	assert cache.bytes == 3
+	assert evicted == []
+
+
+def test_popped_entry_is_evicted() -> None:
+	cache, evicted = make_cache()
+	cache.put("a", "1")
+
+	assert cache.pop("a") == "1"
+	assert cache.pop("a") is None
+	assert len(cache) == 0
+	assert cache.bytes == 0
+	assert evicted == [("a", "1")]
+
+
+def test_clear_doesnt_notify() -> None:
+	cache, evicted = make_cache()
+	cache.put("a", "1")
+	cache.clear()
+
+	assert len(cache) == 0
+	assert cache.bytes == 0
+	assert evicted == []
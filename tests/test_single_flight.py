@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+from sfu_api.timetable import parser
+
+
+def test_concurrent_callers_share_one_call() -> None:
+	calls: int = 0
+
+	async def fetch() -> str:
+		nonlocal calls
+		calls += 1
+		await asyncio.sleep(0.01)
+		return "result"
+
+	async def main() -> list[str]:
+		return await asyncio.gather(*(parser._single_flight("key", fetch) for _ in range(10)))
+
+	assert asyncio.run(main()) == ["result"] * 10
+	assert calls == 1
+	assert "key" not in parser._in_flight
+
+
+def test_different_keys_dont_share() -> None:
+	calls: list[str] = []
+
+	def fetch(key: str):
+		async def _fetch() -> str:
+			calls.append(key)
+			await asyncio.sleep(0.01)
+			return key
+		return _fetch
+
+	async def main() -> list[str]:
+		return await asyncio.gather(*(parser._single_flight(key, fetch(key)) for key in ("a", "b", "a")))
+
+	assert asyncio.run(main()) == ["a", "b", "a"]
+	assert sorted(calls) == ["a", "b"]
+
+
+def test_next_call_after_completion_runs_again() -> None:
+	calls: int = 0
+
+	async def fetch() -> int:
+		nonlocal calls
+		calls += 1
+		return calls
+
+	async def main() -> tuple[int, int]:
+		return await parser._single_flight("key", fetch), await parser._single_flight("key", fetch)
+
+	assert asyncio.run(main()) == (1, 2)
+
+
+def test_error_is_shared_and_forgotten() -> None:
+	calls: int = 0
+
+	async def fetch() -> None:
+		nonlocal calls
+		calls += 1
+		await asyncio.sleep(0.01)
+		raise RuntimeError("upstream is down")
+
+	async def main() -> list:
+		return await asyncio.gather(*(parser._single_flight("key", fetch) for _ in range(3)), return_exceptions=True)
+
+	results: list = asyncio.run(main())
+	assert calls == 1
+	assert all(isinstance(result, RuntimeError) for result in results)
+	assert "key" not in parser._in_flight
+
+
+def test_cancelled_caller_doesnt_cancel_others() -> None:
+	async def fetch() -> str:
+		await asyncio.sleep(0.05)
+		return "result"
+
+	async def main() -> str:
+		impatient = asyncio.ensure_future(parser._single_flight("key", fetch))
+		patient = asyncio.ensure_future(parser._single_flight("key", fetch))
+		await asyncio.sleep(0.01)
+		impatient.cancel()
+		with pytest.raises(asyncio.CancelledError):
+			await impatient
+		return await patient
+
+	assert asyncio.run(main()) == "result"